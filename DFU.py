@@ -2,6 +2,7 @@
 
 from __future__ import print_function
 
+import os
 import struct
 import sys
 import time
@@ -92,12 +93,149 @@ class Status(Enumeration):
 Status.create_from_map()
 
 
+class Trace(object):
+    """Records the control transfers of DFU objects for profiling.
+
+    Each transfer is charged to the innermost DFU method on the call
+    stack that isn't a bare protocol request, so that a GETSTATUS made
+    by set_address() counts as set_address and an UPLOAD from peek()
+    counts as peek.  Enable it for any tool by setting MD380_TRACE to
+    a filename; a Chrome trace (chrome://tracing) is written there and
+    a summary printed to stderr when the tool exits.
+    """
+
+    # Methods that only wrap a single request, charged to their caller.
+    primitives = ('get_status', 'get_state', 'clear_status', 'abort',
+                  'detach', 'download', 'upload', 'wait_status',
+                  'wait_till_ready', '_wait', 'get_command')
+
+    def __init__(self):
+        self.started = time.time()
+        self.events = []
+
+    def attach(self, dfu):
+        """Routes the transfers of a DFU object through this trace."""
+        if not isinstance(dfu._device, TracedDevice):
+            dfu._device = TracedDevice(dfu._device, self)
+
+    def operation(self, frame):
+        """Returns (operation, call path) for a transfer made from frame."""
+        path = []
+        while frame is not None:
+            if isinstance(frame.f_locals.get('self'), DFU):
+                path.append(frame.f_code.co_name)
+            frame = frame.f_back
+        op = [name for name in path if name not in self.primitives]
+        return (op[0] if op else path[-1] if path else '?'), '/'.join(reversed(path))
+
+    def record(self, frame, args, start, duration, result):
+        bmRequestType, bRequest, wValue = args[:3]
+        length = args[4] if len(args) > 4 else 0
+        if not isinstance(length, int):
+            length = len(length) if length is not None else 0
+        op, path = self.operation(frame)
+        self.events.append({
+            'op': op,
+            'path': path,
+            'bmRequestType': bmRequestType,
+            'bRequest': Request.map[int(bRequest)].name
+            if int(bRequest) in Request.map else int(bRequest),
+            'wValue': wValue,
+            'length': length,
+            'start': start,
+            'duration': duration,
+            'result': result,
+        })
+
+    def summary(self):
+        """Returns a table of transfers, bytes and time per operation."""
+        ops = {}
+        for e in self.events:
+            stats = ops.setdefault(e['op'], [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += e['result'] if isinstance(e['result'], int) else 0
+            stats[2] += e['duration']
+        lines = ["%-24s %9s %11s %10s" % ("operation", "transfers", "bytes", "seconds")]
+        for op, (count, size, seconds) in sorted(ops.items(), key=lambda i: -i[1][2]):
+            lines.append("%-24s %9d %11d %10.3f" % (op, count, size, seconds))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """Returns the events in Chrome's trace event format."""
+        return {'traceEvents': [{
+            'name': e['op'],
+            'cat': "%s" % e['bRequest'],
+            'ph': 'X',
+            'ts': (e['start'] - self.started) * 1e6,
+            'dur': e['duration'] * 1e6,
+            'pid': 0,
+            'tid': 0,
+            'args': dict((k, e[k]) for k in
+                         ('path', 'bmRequestType', 'wValue', 'length', 'result')),
+        } for e in self.events]}
+
+    def dump(self, filename):
+        import json
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        sys.stderr.write(self.summary() + "\n")
+
+
+class TracedDevice(object):
+    """Wraps a pyusb Device so that its control transfers are traced."""
+
+    def __init__(self, device, trace):
+        self.__dict__['_device'] = device
+        self.__dict__['_trace'] = trace
+
+    def ctrl_transfer(self, *args, **kwargs):
+        if kwargs:
+            names = ('bmRequestType', 'bRequest', 'wValue', 'wIndex', 'data_or_wLength')
+            args = args + tuple(kwargs.get(n, 0) for n in names[len(args):])
+            kwargs = {}
+        start = time.time()
+        try:
+            data = self._device.ctrl_transfer(*args)
+            result = data if isinstance(data, int) else len(data)
+            return data
+        except Exception as e:
+            result = "%s" % e
+            raise
+        finally:
+            self._trace.record(sys._getframe(1), args, start,
+                               time.time() - start, result)
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._device, name, value)
+
+
+# The trace shared by all DFU objects, when MD380_TRACE is set.
+trace = None
+
+
+def start_trace(filename=None):
+    """Returns the shared Trace, creating it on first use.  With a
+    filename, it is dumped there when the interpreter exits."""
+    global trace
+    if trace is None:
+        trace = Trace()
+        if filename is not None:
+            import atexit
+            atexit.register(trace.dump, filename)
+    return trace
+
+
 class DFU(object):
     verbose = False
 
     def __init__(self, device, alt):
         device.set_interface_altsetting(interface=0, alternate_setting=alt)
         self._device = device
+        if os.environ.get('MD380_TRACE'):
+            start_trace(os.environ['MD380_TRACE']).attach(self)
 
     def detach(self):
         """Detaches from the DFU target."""
@@ -161,8 +299,7 @@ class DFU(object):
         c = (address >> 16) & 0xFF
         d = (address >> 24) & 0xFF
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 0, 0, [0x21, a, b, c, d])
-        self.get_status()  # this changes state
-        status = self.get_status()  # this gets the status
+        status = self.wait_status()
         if status[2] == State.dfuDNLOAD_IDLE:
             if self.verbose:
                 print("Set pointer to 0x%08x." % address)
@@ -179,9 +316,7 @@ class DFU(object):
         c = (address >> 16) & 0xFF
         d = (address >> 24) & 0xFF
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 0, 0, [0x41, a, b, c, d])
-        # time.sleep(0.5);
-        self.get_status()  # this changes state
-        status = self.get_status()  # this gets the status
+        status = self.wait_status()
         if status[2] == State.dfuDNLOAD_IDLE:
             if self.verbose:
                 print("Erased 0x%08x." % address)
@@ -197,9 +332,7 @@ class DFU(object):
         a &= 0xFF
         b &= 0xFF
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 0, 0, [a, b])
-        self.get_status()  # this changes state
-        time.sleep(0.1)
-        status = self.get_status()  # this gets the status
+        status = self.wait_status()
         if status[2] == State.dfuDNLOAD_IDLE:
             if self.verbose:
                 print("Sent custom %02x %02x." % (a, b))
@@ -242,7 +375,8 @@ class DFU(object):
     def get_status(self):
         status_packed = self._device.ctrl_transfer(0xA1, Request.GETSTATUS, 0, 0, 6)
         status = struct.unpack('<BBBBBB', status_packed)
-        return (Status.map[status[0]], (((status[1] << 8) | status[2]) << 8) | status[3],
+        # bwPollTimeout is 3 bytes, little endian.
+        return (Status.map[status[0]], status[1] | status[2] << 8 | status[3] << 16,
                 State.map[status[4]], status[5])
 
     def clear_status(self):
@@ -255,13 +389,50 @@ class DFU(object):
     def abort(self):
         self._device.ctrl_transfer(0x21, Request.ABORT, 0, 0, None)
 
-    def wait_till_ready(self, desired_state=State.dfuIDLE):
-        state = 11
-        status, timeout, state, discarded = self.get_status()
-        while state != State.dfuIDLE:
-            self.clear_status()
-            status, timeout, state, discarded = self.get_status()
-        return
+    # States in which the device is still working on the last request.
+    busy_states = (State.dfuDNLOAD_SYNC, State.dfuDNBUSY,
+                   State.dfuMANIFEST_SYNC, State.dfuMANIFEST)
+
+    # Backoff bounds (seconds) for busy devices that advertise no bwPollTimeout.
+    poll_backoff_min = 0.001
+    poll_backoff_max = 0.1
+
+    def wait_status(self, desired_state=State.dfuDNLOAD_IDLE, timeout=5.0, clear=False):
+        """Polls GETSTATUS until the device leaves its busy states.
+        Sleeps for exactly the bwPollTimeout the device advertises.  If
+        it advertises none, as the applet never does, polls again at
+        once, then with a capped exponential backoff.  With
+        clear set, any settled state other than desired_state is
+        cleared with CLRSTATUS and polled again.  Returns the last
+        status, even if the deadline of timeout seconds has passed."""
+        deadline = time.time() + timeout
+        backoff = 0
+        status = self.get_status()  # this changes state
+        while status[2] != desired_state:
+            now = time.time()
+            if now >= deadline:
+                break
+            if status[2] in self.busy_states:
+                if status[1] > 0:
+                    delay = status[1] / 1000.0
+                else:
+                    delay = backoff
+                    backoff = min(max(backoff * 2, self.poll_backoff_min),
+                                  self.poll_backoff_max)
+                if delay > 0:
+                    time.sleep(min(delay, deadline - now))
+            elif clear:
+                self.clear_status()
+            else:
+                break
+            status = self.get_status()  # this gets the status
+        return status
+
+    def wait_till_ready(self, desired_state=State.dfuIDLE, timeout=30.0):
+        status = self.wait_status(desired_state, timeout, clear=True)
+        if status[2] != desired_state:
+            raise RuntimeError('Device not ready after %g s, status %s, state %s' %
+                               (timeout, status[0], status[2]))
 
     def enter_dfu_mode(self):
         action_map = {
@@ -272,7 +443,7 @@ class DFU(object):
             State.dfuERROR: self.clear_status,
             State.appIDLE: self.detach,
             State.appDETACH: self._wait,
-            State.dfuDNBUSY: self._wait,
+            State.dfuDNBUSY: self.wait_status,
             State.dfuMANIFEST: self.abort,
             State.dfuMANIFEST_WAIT_RESET: self._wait,
             State.dfuIDLE: self._wait
@@ -21,12 +21,14 @@ fetching the raw buffer.
 #define TDFU_SPIFLASHERASE64K        0x03 //u32 address
 #define TDFU_SPIFLASHWRITE_NEW       0x04 //u32 address, u32 size, u8 val[]
 #define TDFU_SPIFLASHGETID           0x05 // (void) -> 4 Byte ID
+#define TDFU_SPIFLASHSTATUS          0x06 // (void) -> echo cmd, u8 status register
 #define TDFU_SPIFLASHSECURITYREGREAD 0x08 // (void)
 #define TDFU_SYSLOG                  0x09 //syslog_dump_dmesg()
 
 //Radio Commands
 #define TDFU_C5000_WRITEREG 0x10 //u8 reg, u8 val
 #define TDFU_C5000_READREG  0x11 //u8 register
+#define TDFU_C5000_READREGS 0x12 //u8 first register, u8 count -> echo cmd, first, count, u8 val[count]
 
 
 //Graphics Commands
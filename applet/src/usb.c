@@ -203,6 +203,19 @@ int usb_dnld_hook(){
 //      md380_spiflash_wait();   // this is the problem :( 
                            // must be polled via dfu commenad?
       break;
+    case TDFU_SPIFLASHSTATUS:
+      //Reads the flash's status register, so the host can poll for the
+      //end of an erase instead of this hook blocking until it's done.
+      //The command is echoed, so the host can tell this firmware from
+      //an older one that ignores the command.
+      *md380_dfu_target_adr=dmesg_tx_buf;
+      memset(dmesg_tx_buf,0,DMESG_SIZE);
+      dmesg_tx_buf[0] = md380_packet[0];
+      md380_spiflash_enable();
+      md380_spi_sendrecv(0x05);
+      dmesg_tx_buf[1] = md380_spi_sendrecv(0x00);
+      md380_spiflash_disable();
+      break;
     case TDFU_SPIFLASHWRITE_NEW: // not working, this is not the problem
       //Re-uses the dmesg transmit buffer.
       *md380_dfu_target_adr=dmesg_tx_buf;
@@ -269,6 +282,28 @@ int usb_dnld_hook(){
       c5000_spi0_writereg(md380_packet[1],md380_packet[2]);
       OS_EXIT_CRITICAL(state);
       break;
+    case TDFU_C5000_READREGS:
+      //Reads a range of registers in one transaction, so the host
+      //doesn't need a round-trip per register.  The command and its
+      //parameters are echoed, so the host can tell this firmware
+      //from an older one that ignores the command.
+      *md380_dfu_target_adr=dmesg_tx_buf;
+      memset(dmesg_tx_buf,0,DMESG_SIZE);
+      {
+        int first = md380_packet[1];
+        int count = md380_packet[2];
+        int i;
+        if( first + count > 0x100 )
+          count = 0x100 - first;
+        dmesg_tx_buf[0] = md380_packet[0];
+        dmesg_tx_buf[1] = first;
+        dmesg_tx_buf[2] = count;
+        state=OS_ENTER_CRITICAL();
+        for( i = 0; i < count; i++ )
+          c5000_spi0_readreg(first + i, dmesg_tx_buf + 3 + i);
+        OS_EXIT_CRITICAL(state);
+      }
+      break;
 #endif //CONFIG_SPIC5000
 
 #ifdef CONFIG_GRAPHICS
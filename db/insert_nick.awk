@@ -1,3 +0,0 @@
-{
-    print $1 FS $2 FS $3 FS "" FS $4 FS $5 FS $6
-}
@@ -1,4 +0,0 @@
-
-{
-    print $1 FS $2 FS "" FS $4 FS $5 FS $6 FS $7
-}
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# asyncio front end for md380-tool.
+#
+# The Tool methods block in control transfers and in the sleeps of
+# wait_status(), which would stall an event loop.  AsyncTool gives each
+# radio a worker thread of its own that runs the blocking calls one at
+# a time, taken from a priority queue, and hands the results back to
+# the loop as futures:
+#
+#     radio = md380_async.AsyncTool(md380_tool.init_dfu())
+#     line = await radio.read_framebuf_line(0)
+#     core = await radio.read_range(0x20000000, 0x20000)
+#
+# Interactive commands (framebuffer, keys, text) are queued ahead of
+# status reads, which are queued ahead of bulk transfers.  Bulk reads
+# are split into chunks so that a screenshot never waits behind more
+# than one chunk of a SPI flash dump.  Cancelling a future drops the
+# command if it has not started yet and stops a chunked read at the
+# next chunk; a control transfer already on the bus runs to completion.
+#
+# asyncio needs Python 3, but like the rest of md380-tools this module
+# avoids the async/await syntax, so it still imports under Python 2.
+# Tool builds its commands as bytes, so it works under either.
+
+from __future__ import print_function
+
+import itertools
+import threading
+
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 10
+PRIORITY_BULK = 20
+
+# Returned by a job that has queued itself again instead of finishing.
+requeued = object()
+
+# Default priorities of the Tool methods; all others are PRIORITY_NORMAL.
+priorities = {
+    'drawtext': PRIORITY_INTERACTIVE,
+    'read_framebuf_line': PRIORITY_INTERACTIVE,
+    'read_framebuf_tile': PRIORITY_INTERACTIVE,
+    'send_keyboard_event': PRIORITY_INTERACTIVE,
+    'read_range': PRIORITY_BULK,
+    'spiflashpeek': PRIORITY_BULK,
+    'spiflashpoke': PRIORITY_BULK,
+    'spiflash_erase64kblock': PRIORITY_BULK,
+}
+
+
+class Job(object):
+    """One blocking call waiting in a device's queue."""
+
+    def __init__(self, future, fn, args):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        # Set from the loop when the future is cancelled, read by the
+        # worker thread before it starts the call.
+        self.cancelled = threading.Event()
+
+
+class AsyncTool(object):
+    """Runs one radio's Tool calls on a dedicated thread, in priority
+    order, returning asyncio futures.
+
+    Any Tool method can be called by name; the result is a future.
+    Pass priority=... to override the default from `priorities`."""
+
+    def __init__(self, tool, loop=None):
+        if asyncio is None:
+            raise RuntimeError('md380_async needs Python 3')
+        self.tool = tool
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.closed = False
+        self.thread = threading.Thread(target=self._worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, priority, job):
+        # The sequence number keeps FIFO order within a priority.
+        self.queue.put((priority, next(self.sequence), job))
+
+    def _worker(self):
+        while True:
+            priority, seq, job = self.queue.get()
+            if job is None:
+                break
+            if job.cancelled.is_set():
+                continue
+            try:
+                result = job.fn(*job.args)
+            except BaseException as e:
+                self.loop.call_soon_threadsafe(self._resolve, job.future, None, e)
+            else:
+                if result is not requeued:  # chunk jobs resolve themselves
+                    self.loop.call_soon_threadsafe(self._resolve, job.future, result, None)
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn(*args) for the worker thread and returns a future.
+
+        fn may be a Tool method or any function of the Tool, such as
+        md380_tool.screenshot with the Tool as its first argument."""
+        if self.closed:
+            raise RuntimeError('AsyncTool is closed')
+        priority = kwargs.pop('priority', PRIORITY_NORMAL)
+        future = self.loop.create_future()
+        job = Job(future, fn, args)
+        future.add_done_callback(lambda f: f.cancelled() and job.cancelled.set())
+        self._put(priority, job)
+        return future
+
+    def __getattr__(self, name):
+        method = getattr(self.tool, name)
+        if not callable(method):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            priority = kwargs.pop('priority', priorities.get(name, PRIORITY_NORMAL))
+            return self.submit(method, *args, priority=priority)
+        return call
+
+    def read_range(self, adr, length, priority=PRIORITY_BULK, chunk=None):
+        """Reads length bytes of memory in chunks, each queued on its
+        own, so that higher priority commands run in between.  Chunks
+        default to the tool's read_chunk_size, one set_address each."""
+        future = self.loop.create_future()
+        data = bytearray()
+        job = Job(future, None, ())
+        future.add_done_callback(lambda f: f.cancelled() and job.cancelled.set())
+
+        def step():
+            size = min(chunk or self.tool.read_chunk_size, length - len(data))
+            data.extend(bytearray(self.tool.read_range(adr + len(data), size)))
+            if len(data) < length:
+                self._put(priority, job)
+                return requeued
+            return data
+
+        job.fn = step
+        self._put(priority, job)
+        return future
+
+    def close(self):
+        """Stops the worker after the queued commands; cancels nothing."""
+        if not self.closed:
+            self.closed = True
+            self.queue.put((float('inf'), next(self.sequence), None))
+
+    def cancel_all(self):
+        """Cancels every command that has not started yet."""
+        while True:
+            try:
+                priority, seq, job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                self.queue.put((priority, seq, job))
+                break
+            job.cancelled.set()
+            self.loop.call_soon_threadsafe(job.future.cancel)
+
+
+def open_all(loop=None):
+    """Returns an AsyncTool for every attached radio."""
+    import md380_fleet
+    import md380_tool
+    return [AsyncTool(md380_tool.init_dfu(dev=radio.dev), loop)
+            for radio in md380_fleet.find_radios()]
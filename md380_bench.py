@@ -0,0 +1,230 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Transport benchmarks for the USB paths of md380-tool and md380-dfu.
+#
+# Each benchmark times one host operation, counting the control
+# transfers it makes, and reports transfers/s, bytes/s and the p50/p99
+# latency per operation.  Results are appended as JSON lines, so runs
+# from before and after a change can be compared.  Without --sim, the
+# radio must be running the patched firmware; the firmware and
+# codeplug benchmarks only run against the simulator, or against a
+# radio in the bootloader when --firmware is given.  --startup times
+# how long md380-tool takes to start and finish each subcommand
+# instead, without a radio (the radio commands stop at "Device not
+# found"), which is all startup cost.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import md380_dfu
+import md380_sim
+import md380_tool
+
+
+class CountingDevice(object):
+    """Wraps a pyusb Device, counting control transfers."""
+
+    def __init__(self, dev):
+        self._dev = dev
+        self.transfers = 0
+
+    def ctrl_transfer(self, *args, **kwargs):
+        self.transfers += 1
+        return self._dev.ctrl_transfer(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._dev, name)
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def measure(name, dev, op, size, iterations, **params):
+    """Runs op() iterations times; op returns the bytes it moved.
+    dev is the CountingDevice, or None if op makes no transfers."""
+    latencies = []
+    moved = 0
+    before = dev.transfers if dev is not None else 0
+    started = time.time()
+    for i in range(iterations):
+        t = time.time()
+        moved += op(i)
+        latencies.append(time.time() - t)
+    elapsed = time.time() - started
+    transfers = dev.transfers - before if dev is not None else 0
+    result = {
+        "name": name,
+        "size": size,
+        "iterations": iterations,
+        "seconds": elapsed,
+        "transfers": transfers,
+        "bytes": moved,
+        "transfers_per_sec": transfers / elapsed,
+        "bytes_per_sec": moved / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+    result.update(params)
+    print("%-20s %6d  %8.1f xfer/s %10.1f B/s  p50 %7.2f ms  p99 %7.2f ms" % (
+        name, size, result["transfers_per_sec"], result["bytes_per_sec"],
+        result["p50_ms"], result["p99_ms"]))
+    sys.stdout.flush()
+    return result
+
+
+def quietly(fn, *args):
+    """Calls fn with its progress output discarded."""
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        return fn(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def bench_tool(dev, sizes, iterations):
+    """Benchmarks the patched firmware's block 1 commands."""
+    dfu = md380_tool.init_dfu(dev=dev)
+    results = []
+    for size in sizes:
+        results.append(measure("peek", dev, lambda i: len(dfu.peek(0x20000000, size)),
+                               size, iterations))
+    for size in [s for s in sizes if s <= 1024]:
+        results.append(measure("spiflashpeek", dev,
+                               lambda i: len(dfu.spiflashpeek(0x100000 + i * 1024, size)),
+                               size, iterations))
+    results.append(measure("read_framebuf_line", dev,
+                           lambda i: len(dfu.read_framebuf_line(i % 128)),
+                           160 * 3, iterations))
+    results.append(measure("getdmesg", dev, lambda i: len(dfu.getdmesg()),
+                           1024, iterations))
+    return results
+
+
+def find_radio():
+    """The radio's USB device, opened directly even when a daemon is
+    serving it, so that the USB path itself is measured."""
+    import usb.core
+    dev = usb.core.find(idVendor=md380_tool.md380_vendor,
+                        idProduct=md380_tool.md380_product)
+    if dev is None:
+        raise RuntimeError('Device not found')
+    return dev
+
+
+def bench_bootloader(dev, firmware, iterations):
+    """Benchmarks firmware download and codeplug upload."""
+    dfu = md380_dfu.init_dfu(dev=dev)
+    results = []
+    results.append(measure("download_firmware", dev,
+                           lambda i: quietly(md380_dfu.download_firmware, dfu, firmware)
+                           and len(firmware),
+                           1024, iterations))
+    fd, path = tempfile.mkstemp(suffix=".bin")
+    os.close(fd)
+    try:
+        results.append(measure("upload_codeplug", dev,
+                               lambda i: quietly(md380_dfu.upload_codeplug, dfu, path)
+                               or os.path.getsize(path),
+                               1024, iterations))
+    finally:
+        os.remove(path)
+    return results
+
+
+# md380-tool subcommands for --startup, with harmless arguments.
+startup_commands = [
+    [],
+    ['lookup', '3120001'],
+    ['dmesg'],
+    ['c5000'],
+    ['screenshot', os.devnull],
+    ['hexdump', '0x20000000'],
+    ['spiflashid'],
+    ['calllog'],
+    ['messages'],
+]
+
+
+def bench_startup(iterations):
+    """Times md380-tool from exec to exit for each subcommand."""
+    tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'md380-tool')
+    env = dict(os.environ)
+    env['MD380_SOCKET'] = os.path.join(tempfile.gettempdir(), 'md380-bench-no-daemon.sock')
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        for args in startup_commands:
+            command = [sys.executable, tool] + args
+            results.append(measure("startup " + (" ".join(args) or "usage"), None,
+                                   lambda i: subprocess.call(command, stdout=devnull,
+                                                             stderr=devnull, env=env) * 0,
+                                   0, iterations))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MD380 USB transport')
+    parser.add_argument('--sim', action='store_true',
+                        help='use md380_sim instead of a radio')
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='simulated seconds per transfer (default 0.0005)')
+    parser.add_argument('--sizes', default='16,256,1024,4096,16384',
+                        help='comma separated transfer sizes for peek/spiflashpeek')
+    parser.add_argument('--iterations', '-n', type=int, default=50)
+    parser.add_argument('--firmware', default=None,
+                        help='firmware image for download_firmware; without --sim '
+                             'the radio must be in the bootloader')
+    parser.add_argument('--startup', action='store_true',
+                        help='time md380-tool startup per subcommand instead')
+    parser.add_argument('--label', default='',
+                        help='free text stored with each result, e.g. a git revision')
+    parser.add_argument('--out', '-o', default='bench.jsonl',
+                        help='JSON lines file to append results to')
+    args = parser.parse_args()
+    sizes = [int(s, 0) for s in args.sizes.split(',')]
+
+    if args.startup:
+        target = "host"
+        results = bench_startup(args.iterations)
+    elif args.sim:
+        target = "sim"
+        results = bench_tool(CountingDevice(md380_sim.SimulatedRadio(latency=args.latency)),
+                             sizes, args.iterations)
+        firmware = os.urandom(0x40000)
+        if args.firmware is not None:
+            with open(args.firmware, 'rb') as f:
+                firmware = f.read()
+        results += bench_bootloader(
+            CountingDevice(md380_sim.SimulatedRadio(mode="bootloader", latency=args.latency)),
+            firmware, max(1, args.iterations // 25))
+    elif args.firmware is not None:
+        target = "radio"
+        with open(args.firmware, 'rb') as f:
+            firmware = f.read()
+        dev = CountingDevice(find_radio())
+        results = bench_bootloader(dev, firmware, 1)
+    else:
+        target = "radio"
+        dev = CountingDevice(find_radio())
+        results = bench_tool(dev, sizes, args.iterations)
+
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+    with open(args.out, 'a') as f:
+        for result in results:
+            result.update({"time": stamp, "target": target, "label": args.label})
+            f.write(json.dumps(result, sort_keys=True) + "\n")
+    print("Appended %d results to %s." % (len(results), args.out))
+
+
+if __name__ == '__main__':
+    main()
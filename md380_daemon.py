@@ -0,0 +1,235 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# md380-tool daemon.
+#
+# Owns the radio's USB handle in one long-running process and serves
+# the Tool operations over a Unix socket, one request at a time.
+# While it runs, md380-tool talks to it instead of enumerating USB
+# itself, so each command costs one socket round-trip.
+#
+# The protocol is one JSON object per line.  A request names a Tool
+# method and its arguments, {"op": "peek", "args": [536870912, 16]},
+# and the reply holds either {"result": ...} or {"error": "..."}.
+# Byte strings travel base64 encoded as {"s": ...} for str and
+# {"b": ...} for arrays of bytes, DFU states and statuses as
+# {"e": ["State", 5]}, and dicts with keys other than strings, such as
+# the register numbers of c5000_snapshot, as {"d": [[key, value], ...]}.
+#
+# The socket lives in a directory of the user's own ($XDG_RUNTIME_DIR,
+# else md380-tool-<uid> in the temporary directory, mode 0700), and
+# clients only follow a socket owned by the same user.
+
+from __future__ import print_function
+
+import base64
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+
+import DFU
+
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
+
+# The Tool methods served to clients.
+operations = (
+    'drawtext', 'read_framebuf_line', 'read_framebuf_tile', 'send_keyboard_event',
+    'peek', 'read_range', 'spiflashgetid', 'spiflashpeek',
+    'spiflash_erase64kblock', 'spiflashpoke', 'getinbox', 'getkey',
+    'c5000peek', 'c5000_snapshot', 'c5000poke', 'custom', 'getdmesg',
+    'md380_custom', 'md380_reboot', 'reboot_to_bootloader', 'upload',
+    'download', 'set_address', 'get_status', 'get_state', 'wait_status',
+    'wait_till_ready', 'enter_dfu_mode', 'get_string', 'get_time', 'set_time',
+    'parse_calibration_data', 'read_calibration',
+)
+
+# Operations after which the radio leaves the bus.  The daemon lets go
+# of it, and the USB error of the vanishing device is no error.
+reboots = ('md380_reboot', 'reboot_to_bootloader')
+
+
+def socket_path():
+    """The daemon's socket, $MD380_SOCKET or md380-tool.sock in the
+    user's runtime directory."""
+    if 'MD380_SOCKET' in os.environ:
+        return os.environ['MD380_SOCKET']
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if not directory:
+        import tempfile
+        directory = os.path.join(tempfile.gettempdir(), 'md380-tool-%d' % os.getuid())
+    return os.path.join(directory, 'md380-tool.sock')
+
+
+def trusted(path):
+    """True if path is a socket of the current user's."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def encode(value):
+    """Makes a value JSON safe, wrapping byte strings in base64."""
+    if isinstance(value, DFU.Enumeration):
+        return {'e': [value.__class__.__name__, value.id]}
+    if isinstance(value, str):
+        return {'s': base64.b64encode(value)}
+    if isinstance(value, (bytearray, bytes)) or hasattr(value, 'tostring'):
+        return {'b': base64.b64encode(bytes(bytearray(value)))}
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    if isinstance(value, dict):
+        if not all(isinstance(k, string_types) for k in value):
+            return {'d': [[encode(k), encode(v)] for k, v in value.items()]}
+        return dict((k, encode(v)) for k, v in value.items())
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict):
+        if 's' in value and len(value) == 1:
+            return str(base64.b64decode(value['s']))
+        if 'b' in value and len(value) == 1:
+            return bytearray(base64.b64decode(value['b']))
+        if 'd' in value and len(value) == 1:
+            return dict((decode(k), decode(v)) for k, v in value['d'])
+        if 'e' in value and len(value) == 1:
+            kind, id = value['e']
+            return getattr(DFU, kind).map[id]
+        return dict((str(k), decode(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if isinstance(value, unicode if sys.version_info[0] == 2 else str):
+        return str(value)
+    return value
+
+
+class Client(object):
+    """Stands in for a Tool, forwarding each method call to the daemon."""
+
+    verbose = False
+
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path or socket_path())
+        self.file = self.sock.makefile('rb')
+
+    def call(self, op, *args):
+        request = json.dumps({'op': op, 'args': encode(list(args))})
+        self.sock.sendall((request + '\n').encode('ascii'))
+        line = self.file.readline()
+        if not line:
+            raise RuntimeError('md380-tool daemon closed the connection')
+        reply = json.loads(line.decode('ascii'))
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return decode(reply['result'])
+
+    def __getattr__(self, name):
+        if name not in operations:
+            raise AttributeError(name)
+        return lambda *args: self.call(name, *args)
+
+
+class Daemon(object):
+    """Serializes client requests onto one Tool, reopening the radio
+    after USB errors."""
+
+    def __init__(self, open_tool):
+        self.open_tool = open_tool
+        self.tool = None
+        self.lock = threading.Lock()
+
+    def handle(self, request):
+        op = request.get('op')
+        if op not in operations:
+            return {'error': 'Unknown operation %s' % op}
+        with self.lock:
+            try:
+                if self.tool is None:
+                    self.tool = self.open_tool()
+                result = getattr(self.tool, op)(*decode(request.get('args', [])))
+                if op in reboots:
+                    self.release()
+                return {'result': encode(result)}
+            except Exception as e:
+                self.release()  # reopen before the next request
+                if op in reboots:
+                    return {'result': None}
+                return {'error': "%s" % e}
+
+    def release(self):
+        """Closes the radio, so that others can open it."""
+        if self.tool is not None:
+            try:
+                import usb.util
+                usb.util.dispose_resources(self.tool._device)
+            except Exception:
+                pass
+        self.tool = None
+
+    def serve_connection(self, conn):
+        f = conn.makefile('rb')
+        try:
+            for line in iter(f.readline, b''):
+                try:
+                    reply = self.handle(json.loads(line.decode('ascii')))
+                except ValueError as e:
+                    reply = {'error': "Bad request: %s" % e}
+                conn.sendall((json.dumps(reply) + '\n').encode('ascii'))
+        except socket.error:
+            pass
+        finally:
+            f.close()
+            conn.close()
+
+    def serve(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        if os.path.exists(path):
+            try:
+                Client(path)
+                raise RuntimeError('md380-tool daemon already running on %s' % path)
+            except socket.error:
+                os.unlink(path)  # stale socket from a dead daemon
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(16)
+        print("Serving the radio on %s." % path)
+        sys.stdout.flush()
+        try:
+            while True:
+                conn, addr = server.accept()
+                t = threading.Thread(target=self.serve_connection, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            server.close()
+            os.unlink(path)
+
+
+def serve(path=None):
+    """Opens the radio and serves it until interrupted."""
+    import md380_tool
+    import usb.core
+
+    def open_tool():
+        dev = usb.core.find(idVendor=md380_tool.md380_vendor,
+                            idProduct=md380_tool.md380_product)
+        if dev is None:
+            raise RuntimeError('Device not found')
+        return md380_tool.init_dfu(dev=dev)
+
+    daemon = Daemon(open_tool)
+    daemon.tool = open_tool()
+    daemon.serve(path or socket_path())
@@ -97,10 +97,8 @@ def download_codeplug(dfu, data):
             if len(packet) < block_size:
                 packet += '\xFF' * (block_size - len(packet))
             dfu.download(block_number, packet)
-            state = 11
-            while state != State.dfuDNLOAD_IDLE:
-                status, timeout, state, discarded = dfu.get_status()
-                # print(status, timeout, state, discarded)
+            status, timeout, state, discarded = dfu.wait_status()
+            # print(status, timeout, state, discarded)
             sys.stdout.write('.')
             sys.stdout.flush()
             block_number += 1
@@ -190,28 +188,55 @@ def upload_codeplug(dfu, filename):
         print("Done.")
 
 
-def download_firmware(dfu, data):
-    """ Download new firmware binary to the radio. """
-    addresses = [
-        0x0800c000,
-        0x08010000,
-        0x08020000,
-        0x08040000,
-        0x08060000,
-        0x08080000,
-        0x080a0000,
-        0x080c0000,
-        0x080e0000]
-    sizes = [0x4000,  # 0c
-             0x10000,  # 1
-             0x20000,  # 2
-             0x20000,  # 4
-             0x20000,  # 6
-             0x20000,  # 8
-             0x20000,  # a
-             0x20000,  # c
-             0x20000]  # e
-    block_ends = [0x11, 0x41, 0x81, 0x81, 0x81, 0x81, 0x81, 0x81, 0x81]
+# Flash sectors written by download_firmware(), and the last block
+# number of each when written in 1kB blocks starting at block 2.
+firmware_addresses = [
+    0x0800c000,
+    0x08010000,
+    0x08020000,
+    0x08040000,
+    0x08060000,
+    0x08080000,
+    0x080a0000,
+    0x080c0000,
+    0x080e0000]
+firmware_sizes = [0x4000,  # 0c
+                  0x10000,  # 1
+                  0x20000,  # 2
+                  0x20000,  # 4
+                  0x20000,  # 6
+                  0x20000,  # 8
+                  0x20000,  # a
+                  0x20000,  # c
+                  0x20000]  # e
+firmware_block_ends = [0x11, 0x41, 0x81, 0x81, 0x81, 0x81, 0x81, 0x81, 0x81]
+
+
+def firmware_sector_hashes(data):
+    """Returns the SHA1 of each flash sector as download_firmware() would
+    leave it, keyed by hex address.  Sectors past the end of the image
+    are erased, so they hash as 0xFF."""
+    import hashlib
+    hashes = {}
+    for address, size in zip(firmware_addresses, firmware_sizes):
+        sector, data = data[:size], data[size:]
+        sector += '\xFF' * (size - len(sector))
+        hashes["%x" % address] = hashlib.sha1(sector).hexdigest()
+    return hashes
+
+
+def download_firmware(dfu, data, manifest=None):
+    """ Download new firmware binary to the radio.
+
+    With a manifest, only the sectors whose hashes differ from the
+    manifest of the previous upgrade are erased and written, and the
+    manifest is rewritten once the upgrade succeeds.  The first sector
+    is always written, because reboot_to_bootloader erases it."""
+    import json
+    import os
+    addresses = firmware_addresses
+    sizes = firmware_sizes
+    block_ends = firmware_block_ends
     try:
         # Are we in the right mode?
         mfg = dfu.get_string(1)
@@ -222,6 +247,26 @@ should see the LED blinking green and red, and then your
 radio will be radio to accept this firmware update.""")
             sys.exit(1)
 
+        if data[0:14] == "OutSecurityBin":  # skip header if present
+            if dfu.verbose:
+                print("Skipping 0x100 byte header in data file")
+            header, data = data[:0x100], data[0x100:]
+
+        hashes = firmware_sector_hashes(data)
+        changed = addresses
+        if manifest is not None:
+            try:
+                with open(manifest, 'r') as f:
+                    old = json.load(f)["sectors"]
+                changed = [address for address in addresses
+                           if address == addresses[0] or
+                           old.get("%x" % address) != hashes["%x" % address]]
+                # Until we finish, the radio matches no manifest.
+                os.remove(manifest)
+            except (IOError, OSError, ValueError, KeyError):
+                print("No usable manifest in %s, writing all sectors." % manifest)
+            print("Writing %d of %d sectors." % (len(changed), len(addresses)))
+
         print("Beginning firmware upgrade.")
         sys.stdout.flush() # let text appear immediately (for mingw)
         status, timeout, state, discarded = dfu.get_status()
@@ -230,7 +275,7 @@ radio will be radio to accept this firmware update.""")
         dfu.md380_custom(0x91, 0x01)
         dfu.md380_custom(0x91, 0x31)
 
-        for address in addresses:
+        for address in changed:
             if dfu.verbose:
                 print("Erasing address@ 0x%x" % address)
                 sys.stdout.flush()
@@ -240,11 +285,6 @@ radio will be radio to accept this firmware update.""")
         block_start = 2
         address_idx = 0
 
-        if data[0:14] == "OutSecurityBin":  # skip header if present
-            if dfu.verbose:
-                print("Skipping 0x100 byte header in data file")
-            header, data = data[:0x100], data[0x100:]
-
         print("Writing firmware:")
 
         assert len(addresses) == len(sizes)
@@ -255,11 +295,17 @@ radio will be radio to accept this firmware update.""")
             sys.stdout.flush() # let text appear immediately (for mingw)
             address = addresses[address_idx]
             size = sizes[address_idx]
-            dfu.set_address(address)
 
             if address_idx != len(addresses) - 1:
                 assert address + size == addresses[address_idx + 1]
 
+            if address not in changed:
+                data = data[size:]
+                address_idx += 1
+                continue
+
+            dfu.set_address(address)
+
             datawritten = 0
             block_number = block_start
 
@@ -278,6 +324,9 @@ radio will be radio to accept this firmware update.""")
                 # if dfu.verbose: sys.stdout.write('.'); sys.stdout.flush()
             # if dfu.verbose: sys.stdout.write('_\n'); sys.stdout.flush()
             address_idx += 1
+        if manifest is not None:
+            with open(manifest, 'w') as f:
+                json.dump({"sectors": hashes}, f, indent=1, sort_keys=True)
         print("100% complete, now safe to disconnect and/or reboot radio")
         return True
     except Exception as e:
@@ -336,9 +385,10 @@ def detach(dfu):
         print('In unexpected state: %s' % dfu.get_state())
 
 
-def init_dfu(alt=0):
-    dev = usb.core.find(idVendor=md380_vendor,
-                        idProduct=md380_product)
+def init_dfu(alt=0, dev=None):
+    if dev is None:
+        dev = usb.core.find(idVendor=md380_vendor,
+                            idProduct=md380_product)
 
     if dev is None:
         raise RuntimeError('Device not found')
@@ -440,6 +490,10 @@ Write a codeplug to the radio. Supported file types: RDT (from official Tytera e
 Write firmware to the radio.
     md380-dfu upgrade <firmware.bin>
 
+Write firmware, erasing only the sectors that differ from the image
+recorded in the manifest by the last upgrade of this radio.
+    md380-dfu upgrade <firmware.bin> <manifest.json>
+
 Read a codeplug and write it to a file.
     md380-dfu read <codeplug.bin>
 
@@ -541,6 +595,15 @@ def main():
             else:
                 usage()
 
+        elif len(sys.argv) == 4:
+            if sys.argv[1] == "upgrade":
+                dfu = init_dfu()
+                with open(sys.argv[2], 'rb') as f:
+                    data = f.read()
+                    result = download_firmware(dfu, data, sys.argv[3])
+            else:
+                usage()
+
         elif len(sys.argv) == 2:
             if sys.argv[1] == 'detach':
                 dfu = init_dfu()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# md380-fleet runs the md380-tool and md380-dfu operations on every
+# radio attached to the host at once, one worker thread per radio.
+# pyusb releases the GIL during control transfers, so the radios on a
+# hub really do work in parallel.
+
+from __future__ import print_function
+
+import json
+import sys
+import threading
+import time
+
+import usb.core
+import usb.util
+
+import md380_dfu
+import md380_tool
+
+md380_vendor = 0x0483
+md380_product = 0xdf11
+
+
+class Radio(object):
+    """One attached 0483:df11 device, identified by its USB location."""
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.bus = dev.bus
+        self.address = dev.address
+        ports = getattr(dev, "port_numbers", None)
+        if ports:
+            self.location = "%d-%s" % (dev.bus, ".".join("%d" % p for p in ports))
+        else:
+            self.location = "%d:%d" % (dev.bus, dev.address)
+        self.serial = None
+        try:
+            if dev.iSerialNumber:
+                self.serial = usb.util.get_string(dev, dev.iSerialNumber)
+        except (usb.core.USBError, ValueError, NotImplementedError):
+            pass
+
+    def __repr__(self):
+        return "%s bus %03d device %03d serial %s" % (
+            self.location, self.bus, self.address, self.serial)
+
+
+def find_radios():
+    """Returns a Radio for every attached MD380, sorted by location."""
+    devs = usb.core.find(find_all=True,
+                         idVendor=md380_vendor,
+                         idProduct=md380_product)
+    return sorted([Radio(dev) for dev in devs], key=lambda r: r.location)
+
+
+def open_radio(location, init=md380_tool.init_dfu):
+    """Opens the radio at a USB location with one of the init_dfu()s."""
+    for radio in find_radios():
+        if radio.location == location or radio.serial == location:
+            return init(dev=radio.dev)
+    raise RuntimeError('Device %s not found' % location)
+
+
+class Progress(object):
+    """Output and outcome of one radio's job.
+
+    The operations report progress by printing, so the worker's
+    stdout is routed here.  Dots count as ticks, and the last
+    complete line is kept for the status display."""
+
+    def __init__(self, radio, log=None):
+        self.radio = radio
+        self.log = log
+        self.ticks = 0
+        self.line = ""
+        self.partial = ""
+        self.error = None
+        self.done = False
+        self.started = time.time()
+        self.finished = None
+
+    def write(self, text):
+        if self.log is not None:
+            self.log.write(text)
+        self.ticks += text.count('.')
+        lines = (self.partial + text).split('\n')
+        self.partial = lines[-1]
+        for line in lines[:-1]:
+            if line.strip(' .'):
+                self.line = line.strip()
+
+    def flush(self):
+        if self.log is not None:
+            self.log.flush()
+
+    def status(self):
+        if self.error is not None:
+            state = "FAILED: %s" % self.error
+        elif self.done:
+            state = "done in %.1fs" % (self.finished - self.started)
+        else:
+            state = "%d %s" % (self.ticks, self.line)
+        return "%-12s %s" % (self.radio.location, state)
+
+
+class ThreadStdout(object):
+    """Sends each thread's writes to its own Progress, and everything
+    else to the real stdout."""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.streams = {}
+
+    def write(self, text):
+        self.streams.get(threading.current_thread().ident, self.stdout).write(text)
+
+    def flush(self):
+        self.streams.get(threading.current_thread().ident, self.stdout).flush()
+
+
+def format_name(template, radio):
+    """Fills {location} and {serial} in a per-radio filename."""
+    return template.format(location=radio.location.replace(':', '-'),
+                           serial=radio.serial or radio.location)
+
+
+def run(job, radios=None, logs=None, interval=0.5):
+    """Runs job(radio) on every radio in parallel, printing a status
+    line per radio until all are finished.  Returns the Progress of
+    each radio; failures are collected in Progress.error."""
+    if radios is None:
+        radios = find_radios()
+    out = ThreadStdout(sys.stdout)
+    progress = []
+
+    def worker(p):
+        out.streams[threading.current_thread().ident] = p
+        try:
+            if job(p.radio) is False:
+                p.error = p.line or "failed"
+        except (Exception, SystemExit) as e:
+            p.error = "%s" % e
+        finally:
+            p.done = True
+            p.finished = time.time()
+            p.flush()
+
+    threads = []
+    for radio in radios:
+        log = None
+        if logs is not None:
+            log = open(format_name(logs, radio), 'w')
+        p = Progress(radio, log)
+        progress.append(p)
+        threads.append(threading.Thread(target=worker, args=(p,)))
+
+    stdout, sys.stdout = sys.stdout, out
+    try:
+        for t in threads:
+            t.daemon = True
+            t.start()
+        while any(t.is_alive() for t in threads):
+            time.sleep(interval)
+            stdout.write("\n".join(p.status() for p in progress) + "\n\n")
+            stdout.flush()
+    finally:
+        sys.stdout = stdout
+        for p in progress:
+            if p.log is not None:
+                p.log.close()
+    return progress
+
+
+def upgrade_job(filename, manifest=None):
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    def job(radio):
+        dfu = md380_dfu.init_dfu(dev=radio.dev)
+        if manifest is None:
+            return md380_dfu.download_firmware(dfu, data)
+        return md380_dfu.download_firmware(dfu, data, format_name(manifest, radio))
+    return job
+
+
+def read_codeplug_job(filename):
+    def job(radio):
+        dfu = md380_dfu.init_dfu(dev=radio.dev)
+        md380_dfu.upload_codeplug(dfu, format_name(filename, radio))
+    return job
+
+
+def write_codeplug_job(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    def job(radio):
+        dfu = md380_dfu.init_dfu(dev=radio.dev)
+        md380_dfu.download_codeplug(dfu, data)
+    return job
+
+
+def spiflashwrite_job(filename, adr, update=False):
+    def job(radio):
+        dfu = md380_tool.init_dfu(dev=radio.dev)
+        if update:
+            md380_tool.spiflashupdate(dfu, filename, adr)
+        else:
+            md380_tool.spiflashwrite(dfu, filename, adr)
+    return job
+
+
+def calibration_job(filename):
+    def job(radio):
+        dfu = md380_tool.init_dfu(dev=radio.dev)
+        freqs = dfu.read_calibration()
+        with open(format_name(filename, radio), 'w') as f:
+            json.dump(freqs, f, indent=4)
+    return job
+
+
+def macro_job(filename):
+    import md380_macro
+
+    def job(radio):
+        dfu = md380_tool.init_dfu(dev=radio.dev)
+        md380_macro.run_file(dfu, filename)
+    return job
+
+
+def usage():
+    print("""
+Usage: md380-fleet <command> <arguments>
+
+Runs a command on every attached radio in parallel, printing a status
+line per radio.  In filenames, {location} and {serial} are replaced
+per radio.  Set MD380_FLEET_LOG=<name-{location}.log> to keep each
+radio's full output.
+
+List the attached radios.
+    md380-fleet list
+
+Write firmware to every radio (which must be in the bootloader),
+optionally skipping unchanged sectors with per-radio manifests.
+    md380-fleet upgrade <firmware.bin> [manifest-{serial}.json]
+
+Read every codeplug.
+    md380-fleet read <codeplug-{serial}.bin>
+Write one codeplug to every radio.
+    md380-fleet write <codeplug.bin>
+
+Copy a file to every radio's SPI flash, in full or changed blocks only.
+    md380-fleet spiflashwrite <user.bin> <address>
+    md380-fleet spiflashupdate <user.bin> <address>
+
+Run a remote key macro on every radio, e.g. to set them up alike.
+    md380-fleet macro <macro.txt>
+
+Dump every radio's calibration data.
+    md380-fleet calibration <calibration-{serial}.json>
+""")
+
+
+def main():
+    import os
+    try:
+        job = None
+        if len(sys.argv) == 2 and sys.argv[1] == 'list':
+            for radio in find_radios():
+                print(radio)
+        elif len(sys.argv) in (3, 4) and sys.argv[1] == 'upgrade':
+            job = upgrade_job(*sys.argv[2:])
+        elif len(sys.argv) == 3 and sys.argv[1] == 'read':
+            job = read_codeplug_job(sys.argv[2])
+        elif len(sys.argv) == 3 and sys.argv[1] == 'write':
+            job = write_codeplug_job(sys.argv[2])
+        elif len(sys.argv) == 4 and sys.argv[1] in ('spiflashwrite', 'spiflashupdate'):
+            adr = int(sys.argv[3], 16)
+            if adr < 0x100000:
+                print("address too low")
+                exit(1)
+            job = spiflashwrite_job(sys.argv[2], adr, sys.argv[1] == 'spiflashupdate')
+        elif len(sys.argv) == 3 and sys.argv[1] == 'macro':
+            job = macro_job(sys.argv[2])
+        elif len(sys.argv) == 3 and sys.argv[1] == 'calibration':
+            job = calibration_job(sys.argv[2])
+        else:
+            usage()
+
+        if job is not None:
+            radios = find_radios()
+            if not radios:
+                raise RuntimeError('Device not found')
+            progress = run(job, radios, os.environ.get('MD380_FLEET_LOG'))
+            for p in progress:
+                print(p.status())
+            if any(p.error is not None for p in progress):
+                exit(1)
+    except RuntimeError as e:
+        print(e.args[0])
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Remote key macros for the patched firmware.
+#
+# A macro is a text file with one command per line; lines starting
+# with '#' and blank lines are skipped:
+#
+#     keys M U U 1            tap keys: M U D B 0-9 * #
+#     press M / release M     press or release one key
+#     hold B 1.5              press, keep down for seconds, release
+#     wait 0.5                pause
+#     expect 0 0 159 15 3a5f... [timeout]
+#                             wait until a rectangle of the screen
+#                             has this sha1, else fail
+#     snap 0 0 159 15         print the expect line for the rectangle
+#                             as it is now, for writing macros
+#
+# The applet keeps one remote key, which the keyboard polls (every
+# 24 ms in irq_handlers.c) and Tytera's menu task pick up from RAM; a
+# release clears it at once.  So each press is held for key_hold
+# seconds and each release left as long before the next press, enough
+# for two polls.  The DFU status of a key event only confirms the USB
+# transfer, and for the same reason press/release pairs can't be sent
+# in one transfer: the release would land before any poll saw the
+# press.  Instead of sleeping until the menu has caught up, expect
+# polls a small part of the framebuffer until it shows what it should.
+
+from __future__ import print_function
+
+import hashlib
+import sys
+import time
+
+import md380_tool
+
+keys = "MUDB0123456789*#"
+
+# Seconds a key is held down, and left up after its release.
+key_hold = 0.05
+
+
+def read_rect(dfu, x1, y1, x2, y2):
+    """Reads a rectangle of the screen in as few tiles as fit the
+    firmware's buffer.  Returns None if the LCD stayed busy."""
+    row = 3 * (1 + x2 - x1)
+    rows = max(1, (md380_tool.dmesg_size - 5) // row)
+    if row > md380_tool.dmesg_size - 5:
+        raise RuntimeError('Rectangle too wide to read, %d pixels' % (1 + x2 - x1))
+    data = bytearray()
+    for y in range(y1, y2 + 1, rows):
+        for attempt in range(20):
+            pixels = dfu.read_framebuf_tile(x1, y, x2, min(y + rows - 1, y2))
+            if pixels is not None:
+                break
+            time.sleep(0.01)
+        else:
+            return None
+        data += bytearray(pixels)
+    return data
+
+
+def rect_hash(dfu, rect):
+    data = read_rect(dfu, *rect)
+    if data is None:
+        return None
+    return hashlib.sha1(bytes(data)).hexdigest()
+
+
+class Macro(object):
+    """Runs macro commands against one radio."""
+
+    def __init__(self, dfu, out=sys.stdout, timeout=5.0, poll=0.02, hold=key_hold):
+        self.dfu = dfu
+        self.out = out
+        self.timeout = timeout
+        self.poll = poll
+        self.hold = hold
+
+    def key(self, key, pressed, hold=None):
+        """Presses or releases a key, then waits until the firmware
+        has polled the new state."""
+        if key not in keys:
+            raise RuntimeError('Unknown key %s' % key)
+        self.dfu.send_keyboard_event(key, pressed)
+        time.sleep(max(self.hold, hold or 0))
+
+    def tap(self, key):
+        self.key(key, 1)
+        self.key(key, 0)
+
+    def expect(self, rect, digest, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        while True:
+            now = rect_hash(self.dfu, rect)
+            if now == digest:
+                return
+            if time.time() > deadline:
+                raise RuntimeError('Screen %d %d %d %d is %s, expected %s' %
+                                   (rect + (now, digest)))
+            time.sleep(self.poll)
+
+    def command(self, line):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            return
+        cmd, args = words[0], words[1:]
+        if cmd == 'keys':
+            for key in "".join(args):
+                self.tap(key)
+        elif cmd == 'press':
+            self.key(args[0], 1)
+        elif cmd == 'release':
+            self.key(args[0], 0)
+        elif cmd == 'hold':
+            self.key(args[0], 1, float(args[1]))
+            self.key(args[0], 0)
+        elif cmd == 'wait':
+            time.sleep(float(args[0]))
+        elif cmd == 'expect':
+            rect = tuple(int(a, 0) for a in args[0:4])
+            timeout = float(args[5]) if len(args) > 5 else None
+            self.expect(rect, args[4].lower(), timeout)
+        elif cmd == 'snap':
+            rect = tuple(int(a, 0) for a in args[0:4])
+            self.out.write("expect %d %d %d %d %s\n" % (rect + (rect_hash(self.dfu, rect),)))
+        else:
+            raise RuntimeError('Unknown macro command %s' % cmd)
+
+    def run(self, lines):
+        for number, line in enumerate(lines, 1):
+            try:
+                self.command(line)
+            except (RuntimeError, IndexError, ValueError) as e:
+                raise RuntimeError('Line %d: %s: %s' % (number, line.strip(), e))
+
+
+def run_file(dfu, filename):
+    with open(filename) as f:
+        Macro(dfu).run(f)
@@ -0,0 +1,425 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Simulated MD380 for testing the host tools without a radio.
+#
+# SimulatedRadio stands in for a pyusb Device.  It speaks the DFU
+# subset of the Tytera bootloader (block 0 commands, block >= 2
+# transfers) and the block 1 TDFU commands of the patched applet from
+# applet/src/usb.c, backed by in-memory images of internal flash, RAM
+# and SPI flash.  Hand one to any init_dfu():
+#
+#     import md380_sim, md380_tool
+#     dfu = md380_tool.init_dfu(dev=md380_sim.SimulatedRadio())
+#     print(dfu.getdmesg())
+
+from __future__ import print_function
+
+import array
+import datetime
+import random
+import time
+
+import usb.core
+
+from DFU import Request, State, Status
+
+flash_base = 0x08000000
+flash_size = 1024 * 1024
+ram_base = 0x20000000
+ram_size = 128 * 1024
+rtc_base = 0x40002800
+
+DMESG_SIZE = 1024
+DMESG_START = 0x2001f700  # dmesg_tx_buf, see applet/src/dmesg.h
+dmesg_ring = 0x10000000  # dmesg_start[] lives in core coupled RAM
+
+lcd_width = 160
+lcd_height = 128
+
+# STM32F405 flash sectors: 4 * 16kB, 64kB, 7 * 128kB.
+flash_sectors = ([0x08000000 + n * 0x4000 for n in range(4)] +
+                 [0x08010000] +
+                 [0x08020000 + n * 0x20000 for n in range(7)] +
+                 [0x08100000])
+
+
+def load_image(image, size, fill):
+    """Returns a bytearray of size bytes from a filename, string or
+    None, padded with fill."""
+    if image is None:
+        data = bytearray()
+    elif isinstance(image, bytearray):
+        data = image
+    else:
+        try:
+            with open(image, 'rb') as f:
+                data = bytearray(f.read())
+        except (IOError, TypeError):
+            data = bytearray(image)
+    return data[:size] + bytearray([fill]) * (size - len(data))
+
+
+def bcd(n):
+    return ((n // 10) << 4) | (n % 10)
+
+
+class SimulatedRadio(object):
+    """Pretends to be the pyusb Device of an MD380.
+
+    mode is "app" for the patched application, which answers the block 1
+    TDFU commands, or "bootloader" for the Tytera bootloader.  Each
+    control transfer sleeps latency seconds plus byte_time per byte.
+    poll_timeout is the bwPollTimeout in ms reported while busy, and
+    lcd_busy the chance that a framebuffer read finds the LCD busy.
+    c5000_readregs=False simulates firmware from before the batched
+    C5000 register read, spiflash_status=False one from before the SPI
+    Flash status read.  A 64kB erase keeps the flash busy for
+    erase_time seconds, and like the chip it ignores erases meanwhile."""
+
+    idVendor = 0x0483
+    idProduct = 0xdf11
+    iManufacturer = 1
+    iProduct = 2
+    iSerialNumber = 3
+    langids = (0x0409,)
+
+    def __init__(self, mode="app", flash=None, ram=None, spiflash=None,
+                 spiflash_size=16 * 1024 * 1024, latency=0.0, byte_time=0.0,
+                 poll_timeout=0, lcd_busy=0.0, max_upload=None,
+                 serial="SIM0001", bus=1, address=1, port_numbers=(1,),
+                 c5000_readregs=True, spiflash_status=True, erase_time=0.0):
+        self.mode = mode
+        self.flash = load_image(flash, flash_size, 0xFF)
+        self.ram = load_image(ram, ram_size, 0x00)
+        self.spiflash = load_image(spiflash, spiflash_size, 0xFF)
+        self.latency = latency
+        self.byte_time = byte_time
+        self.poll_timeout = poll_timeout
+        self.lcd_busy = lcd_busy
+        self.max_upload = max_upload
+        self.serial = serial
+        self.bus = bus
+        self.address = address
+        self.port_numbers = port_numbers
+        self.c5000_readregs = c5000_readregs
+        self.spiflash_status = spiflash_status
+        self.erase_time = erase_time
+        self.erase_done = 0.0
+        self.default_timeout = 1000
+        self.random = random.Random(380)
+
+        self.c5000 = bytearray(256)
+        self.framebuffer = bytearray(lcd_width * lcd_height * 3)
+        self.dmesg = bytearray(DMESG_SIZE)
+        self.dmesg_wcurs = 0
+        self.keys = []  # (ascii, pressed) remote key events, oldest first
+        self.texts = []  # (x, y, text) from TDFU_PRINT
+        self.customs = []  # (a, b) block 0 custom commands
+        self.clock_offset = datetime.timedelta(0)
+        self.calibration = bytearray(512)
+        self.reboots = 0
+        self.transfers = 0
+
+        self.state = State.dfuIDLE
+        self.status = Status.OK
+        self.pending = None
+        self.pointer = 0
+        self.target = dmesg_ring
+        self.space = "memory"  # or "spiflash", once the codeplug is selected
+        self.upload0 = bytearray()
+
+    # pyusb Device interface.
+
+    @property
+    def manufacturer(self):
+        return self.string(self.iManufacturer)
+
+    def set_interface_altsetting(self, interface=None, alternate_setting=None):
+        pass
+
+    def string(self, index):
+        if index == self.iManufacturer:
+            if self.mode == "bootloader":
+                return u"AnyRoad Technology"
+            return u"Travis Goodspeed KK4VCZ"
+        if index == self.iProduct:
+            return u"Digital Radio in DFU"
+        if index == self.iSerialNumber:
+            return u"%s" % self.serial
+        return u""
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
+                      data_or_wLength=None, timeout=None):
+        self.transfers += 1
+        if bmRequestType & 0x80:
+            result = self.control_in(bmRequestType, int(bRequest), wValue, wIndex,
+                                     data_or_wLength)
+            size = len(result)
+        else:
+            data = bytearray(data_or_wLength or [])
+            self.control_out(int(bRequest), wValue, data)
+            result = size = len(data)
+        if self.latency or self.byte_time:
+            time.sleep(self.latency + self.byte_time * size)
+        return result
+
+    def control_in(self, bmRequestType, bRequest, wValue, wIndex, length):
+        if bmRequestType == 0x80 and bRequest == 0x06:  # GET_DESCRIPTOR
+            if wValue & 0xFF == 0:
+                desc = bytearray([4, 3, 0x09, 0x04])
+            else:
+                text = self.string(wValue & 0xFF).encode('utf-16-le')
+                desc = bytearray([len(text) + 2, 3]) + bytearray(text)
+            return array.array('B', desc[:length])
+        if bRequest == Request.GETSTATUS.id:
+            self.poll()
+            timeout = self.poll_timeout if self.state == State.dfuDNBUSY else 0
+            # bwPollTimeout is 3 bytes, little endian.
+            return array.array('B', [self.status.id, timeout & 0xFF,
+                                     (timeout >> 8) & 0xFF, (timeout >> 16) & 0xFF,
+                                     self.state.id, 0])
+        if bRequest == Request.GETSTATE.id:
+            return array.array('B', [self.state.id])
+        if bRequest == Request.UPLOAD.id:
+            if self.state not in (State.dfuIDLE, State.dfuDNLOAD_IDLE,
+                                  State.dfuUPLOAD_IDLE):
+                return self.stall(Status.errSTALLEDPKT)
+            if self.max_upload is not None:
+                length = min(length, self.max_upload)
+            if wValue == 0:
+                data = self.upload0[:length]
+            elif wValue == 1 and self.mode == "app":
+                data = self.upload_block1(length)
+            else:
+                data = self.read(self.pointer + (wValue - 2) * length, length)
+            if self.state == State.dfuIDLE:
+                self.state = State.dfuUPLOAD_IDLE
+            return array.array('B', data)
+        return self.stall(Status.errSTALLEDPKT)
+
+    def control_out(self, bRequest, wValue, data):
+        if bRequest == Request.DNLOAD.id:
+            if self.state not in (State.dfuIDLE, State.dfuDNLOAD_IDLE,
+                                  State.dfuUPLOAD_IDLE):
+                self.stall(Status.errSTALLEDPKT)
+            self.pending = (wValue, data)
+            self.state = State.dfuDNLOAD_SYNC
+        elif bRequest == Request.CLRSTATUS.id:
+            self.state = State.dfuIDLE
+            self.status = Status.OK
+        elif bRequest == Request.ABORT.id:
+            self.state = State.dfuIDLE
+        elif bRequest == Request.DETACH.id:
+            self.state = State.dfuIDLE
+        else:
+            self.stall(Status.errSTALLEDPKT)
+
+    def stall(self, status):
+        self.state = State.dfuERROR
+        self.status = status
+        raise usb.core.USBError('Pipe error', 32, 32)
+
+    def poll(self):
+        """Advances the state machine on GETSTATUS, running a pending
+        download as the real firmware does."""
+        if self.state == State.dfuDNLOAD_SYNC:
+            block, data = self.pending
+            self.pending = None
+            try:
+                if block == 0:
+                    self.command0(data)
+                elif block == 1 and self.mode == "app":
+                    self.command1(data)
+                else:
+                    self.write(self.pointer + (block - 2) * len(data), data)
+                self.state = State.dfuDNBUSY
+                if self.pending == "reboot":  # comes back up idle
+                    self.pending = None
+                    self.state = State.dfuIDLE
+                    self.space = "memory"
+            except (IndexError, ValueError):
+                self.state = State.dfuERROR
+                self.status = Status.errADDRESS
+        elif self.state == State.dfuDNBUSY:
+            self.state = State.dfuDNLOAD_IDLE
+
+    # Memory model.
+
+    def region(self, adr):
+        """Returns the backing bytearray and offset of an address."""
+        if self.space == "spiflash":
+            return self.spiflash, adr
+        if flash_base <= adr < flash_base + flash_size:
+            return self.flash, adr - flash_base
+        if ram_base <= adr < ram_base + ram_size:
+            return self.ram, adr - ram_base
+        if adr == dmesg_ring:
+            return self.dmesg, 0
+        if adr == rtc_base:
+            now = datetime.datetime.now() + self.clock_offset
+            rtc = bytearray([bcd(now.second), bcd(now.minute), bcd(now.hour), 0,
+                             bcd(now.day), bcd(now.month), bcd(now.year % 100), 0])
+            return rtc, 0
+        return None, 0
+
+    def read(self, adr, length):
+        mem, offset = self.region(adr)
+        if mem is None:
+            return bytearray(length)
+        data = mem[offset:offset + length]
+        return data + bytearray(length - len(data))
+
+    def write(self, adr, data):
+        """Programs data like NOR flash, which can only clear bits."""
+        mem, offset = self.region(adr)
+        if mem is None or offset + len(data) > len(mem):
+            raise ValueError("Write outside memory at 0x%08x" % adr)
+        for i, b in enumerate(data):
+            if mem is self.ram:
+                mem[offset + i] = b
+            else:
+                mem[offset + i] &= b
+
+    def erase(self, adr):
+        if self.space == "spiflash":
+            start = adr & ~0xFFFF
+            self.spiflash[start:start + 0x10000] = bytearray(b'\xff' * 0x10000)
+            return
+        for start, end in zip(flash_sectors, flash_sectors[1:]):
+            if start <= adr < end:
+                self.flash[start - flash_base:end - flash_base] = \
+                    bytearray(b'\xff' * (end - start))
+                return
+        raise ValueError("No flash sector at 0x%08x" % adr)
+
+    def printf(self, text):
+        """Appends to the dmesg ring like md380_putc()."""
+        for c in bytearray(text.encode('ascii')):
+            self.dmesg[self.dmesg_wcurs % DMESG_SIZE] = c
+            self.dmesg_wcurs += 1
+            self.dmesg[self.dmesg_wcurs % DMESG_SIZE] = 0
+
+    # Tytera block 0 commands.
+
+    def command0(self, data):
+        if data[0] == 0x21 and len(data) == 5:  # set address pointer
+            self.pointer = self.target = data[1] | data[2] << 8 | data[3] << 16 | data[4] << 24
+        elif data[0] == 0x41 and len(data) == 5:  # erase
+            self.erase(data[1] | data[2] << 8 | data[3] << 16 | data[4] << 24)
+        elif data[0] == 0xb5:  # set the clock, BCD yyyymmddHHMMSS
+            t = [int("%02x" % b) for b in data[1:8]]
+            now = datetime.datetime(t[0] * 100 + t[1], t[2], t[3], t[4], t[5], t[6])
+            self.clock_offset = now - datetime.datetime.now()
+        elif len(data) == 2:
+            a, b = data[0], data[1]
+            self.customs.append((a, b))
+            if a == 0x91 and b == 0x05:
+                self.reboots += 1
+                self.pending = "reboot"
+            elif a == 0x91 and b == 0x31:
+                self.space = "memory"  # firmware upgrade
+            elif a == 0xA2:
+                if b in (0x02, 0x03, 0x04, 0x07):
+                    self.space = "spiflash"  # codeplug
+                self.upload0 = self.info(b)
+
+    def info(self, b):
+        """What an UPLOAD from block 0 returns after custom 0xA2, b."""
+        if b == 0x01:
+            return bytearray(b"DR780" + b"\0" * 27)
+        if b == 0x05:
+            return self.calibration
+        if b == 0x08:
+            now = datetime.datetime.now() + self.clock_offset
+            return bytearray([bcd(now.year // 100), bcd(now.year % 100), bcd(now.month),
+                              bcd(now.day), bcd(now.hour), bcd(now.minute), bcd(now.second)])
+        return bytearray(32)
+
+    # Patched applet block 1 commands, see applet/src/usb.c.
+
+    def upload_block1(self, length):
+        if self.target == dmesg_ring:
+            data = self.dmesg[:]
+            self.dmesg = bytearray(DMESG_SIZE)  # dmesg_flush()
+            self.dmesg_wcurs = 0
+            self.ram[DMESG_START - ram_base:DMESG_START - ram_base + DMESG_SIZE] = data
+            return self.read(DMESG_START, length)
+        return self.read(self.target, length)
+
+    def tx(self, data=b''):
+        """Points the target at dmesg_tx_buf and fills it with data."""
+        self.target = DMESG_START
+        self.ram[DMESG_START - ram_base:DMESG_START - ram_base + DMESG_SIZE] = \
+            (bytearray(data) + bytearray(DMESG_SIZE))[:DMESG_SIZE]
+
+    def command1(self, packet):
+        cmd = packet[0]
+        u32 = lambda n: packet[n] | packet[n + 1] << 8 | packet[n + 2] << 16 | packet[n + 3] << 24
+        if cmd == 0x00:  # TDFU_DMESG
+            self.target = dmesg_ring
+        elif cmd == 0x01:  # TDFU_SPIFLASHREAD
+            adr = u32(1)
+            self.printf("Dumping %d bytes from 0x%08x in SPI Flash\n" % (DMESG_SIZE, adr))
+            self.tx(self.spiflash[adr:adr + DMESG_SIZE])
+        elif cmd in (0x02, 0x04):  # TDFU_SPIFLASHWRITE, TDFU_SPIFLASHWRITE_NEW
+            adr, size = u32(1), u32(5)
+            self.tx()
+            if len(self.spiflash) > adr:
+                data = packet[9:9 + size]
+                if cmd == 0x04:  # whole 256 byte pages
+                    data += bytearray(b'\xff' * (-len(data) % 256))
+                self.space, space = "spiflash", self.space
+                try:
+                    self.write(adr, data)
+                finally:
+                    self.space = space
+        elif cmd == 0x03:  # TDFU_SPIFLASHERASE64K
+            adr = u32(1)
+            self.tx()
+            if len(self.spiflash) > adr and time.time() >= self.erase_done:
+                self.printf("TDFU_SPIFLASHERASE64K %x \n" % adr)
+                start = adr & ~0xFFFF
+                self.spiflash[start:start + 0x10000] = bytearray(b'\xff' * 0x10000)
+                self.erase_done = time.time() + self.erase_time
+        elif cmd == 0x05:  # TDFU_SPIFLASHGETID
+            ids = {16 * 1024 * 1024: 0x18, 1024 * 1024: 0x14}
+            self.tx([0xef, 0x40, ids.get(len(self.spiflash), 0), 0])
+        elif cmd == 0x06 and self.spiflash_status:  # TDFU_SPIFLASHSTATUS
+            self.tx([cmd, 1 if time.time() < self.erase_done else 0])
+        elif cmd == 0x08:  # TDFU_SPIFLASHSECURITYREGREAD
+            self.tx()
+        elif cmd == 0x09:  # TDFU_SYSLOG
+            pass
+        elif cmd == 0x10:  # TDFU_C5000_WRITEREG
+            self.tx()
+            self.c5000[packet[1]] = packet[2]
+        elif cmd == 0x11:  # TDFU_C5000_READREG
+            self.tx([self.c5000[packet[1]]])
+        elif cmd == 0x12 and self.c5000_readregs:  # TDFU_C5000_READREGS
+            first, count = packet[1], min(packet[2], 0x100 - packet[1])
+            self.tx(bytearray([cmd, first, count]) + self.c5000[first:first + count])
+        elif cmd == 0x80:  # TDFU_PRINT
+            text = bytes(packet[3:]).decode('utf-16-le', 'ignore').split(u'\0')[0]
+            self.texts.append((packet[1], packet[2], text))
+        elif cmd == 0x84:  # TDFU_READ_FRAMEBUFFER_24BPP
+            self.read_framebuffer(packet)
+        elif cmd == 0x85:  # TDFU_REMOTE_KEY_EVENT
+            self.keys.append((chr(packet[1]), packet[2]))
+        elif cmd == 0x86:  # TDFU_REBOOT_TO_BOOTLOADER
+            self.erase(0x0800C000)
+            self.mode = "bootloader"
+        else:
+            self.printf("Unhandled DFU packet type 0x%02x.\n" % cmd)
+
+    def read_framebuffer(self, packet):
+        x1, y1, x2, y2 = packet[1:5]
+        reply = bytearray([packet[0], 0xFF, 0xFF, 0xFF, 0xFF])
+        w, h = 1 + x2 - x1, 1 + y2 - y1
+        if self.random.random() >= self.lcd_busy and 0 < 3 * w * h <= DMESG_SIZE \
+                and x2 < lcd_width and y2 < lcd_height:
+            reply = bytearray(packet[0:5])
+            for y in range(y1, y2 + 1):
+                offset = (y * lcd_width + x1) * 3
+                reply += self.framebuffer[offset:offset + 3 * w]
+        self.tx(reply)
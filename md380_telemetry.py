@@ -0,0 +1,234 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# md380-telemetry samples C5000 registers and RAM words as fast as the
+# USB link allows, for antenna and site surveys.
+#
+# Each sample is one batched C5000 register read plus one peek of the
+# RAM span covering the watched words, stamped with the host time.
+# Samples are streamed to a CSV or NumPy .npy file (the .npy writer
+# needs no numpy; load it with numpy.load()), and the last --ring
+# samples are kept in memory for a rolling summary of rate and
+# min/mean/max per column.
+
+from __future__ import print_function
+
+import argparse
+import array
+import struct
+import sys
+import time
+
+import md380_tool
+
+# RSSI high and low byte, as read by md380-tool rssi.
+default_registers = [0x43, 0x44]
+
+
+class Column(object):
+    """One sampled value: a C5000 register (u8) or a RAM word (u32)."""
+
+    def __init__(self, kind, address):
+        self.kind = kind
+        self.address = address
+        if kind == "c5000":
+            self.name = "c5000_%02x" % address
+            self.npy_type, self.struct_type = "<u1", "B"
+        else:
+            self.name = "ram_%08x" % address
+            self.npy_type, self.struct_type = "<u4", "L"
+
+
+class Sampler(object):
+    """Reads all columns of one sample in as few transfers as possible."""
+
+    def __init__(self, dfu, registers, words):
+        self.dfu = dfu
+        self.registers = sorted(set(registers))
+        self.words = sorted(set(words))
+        self.columns = ([Column("c5000", r) for r in self.registers] +
+                        [Column("ram", w) for w in self.words])
+        # One peek when the words are close enough, else one per word.
+        if self.words and self.words[-1] + 4 - self.words[0] <= md380_tool.dmesg_size:
+            self.spans = [(self.words[0], self.words[-1] + 4 - self.words[0])]
+        else:
+            self.spans = [(w, 4) for w in self.words]
+
+    def sample(self):
+        """Returns (timestamp, [values...]) in column order."""
+        t = time.time()
+        values = []
+        if self.registers:
+            regs = self.dfu.c5000_snapshot(self.registers)
+            values.extend(regs[r] for r in self.registers)
+        for adr, size in self.spans:
+            data = bytearray(self.dfu.peek(adr, size))
+            for w in self.words:
+                if adr <= w < adr + size:
+                    values.append(struct.unpack_from("<L", bytes(data), w - adr)[0])
+        return t, values
+
+
+class Ring(object):
+    """The last `size` samples, one preallocated array per column."""
+
+    def __init__(self, columns, size):
+        self.size = size
+        self.count = 0
+        self.times = array.array('d', [0.0] * size)
+        self.values = [array.array('d', [0.0] * size) for c in columns]
+
+    def append(self, t, values):
+        i = self.count % self.size
+        self.times[i] = t
+        for column, v in zip(self.values, values):
+            column[i] = v
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def rate(self):
+        """Samples per second over the ring."""
+        n = len(self)
+        if n < 2:
+            return 0.0
+        newest = self.times[(self.count - 1) % self.size]
+        oldest = self.times[(self.count - n) % self.size]
+        return (n - 1) / max(newest - oldest, 1e-9)
+
+    def stats(self, index):
+        column = self.values[index][:len(self)]
+        return min(column), sum(column) / len(column), max(column)
+
+
+class CsvWriter(object):
+    def __init__(self, filename, columns):
+        self.f = open(filename, 'w')
+        self.f.write(",".join(["time"] + [c.name for c in columns]) + "\n")
+
+    def write(self, t, values):
+        self.f.write("%.6f,%s\n" % (t, ",".join("%d" % v for v in values)))
+
+    def close(self):
+        self.f.close()
+
+
+class NpyWriter(object):
+    """Streams a structured NumPy array, fixing up its shape on close."""
+
+    def __init__(self, filename, columns):
+        self.f = open(filename, 'wb')
+        self.columns = columns
+        self.format = "<d" + "".join(c.struct_type for c in columns)
+        # Room for any sample count, so the data never has to move.
+        self.count = 10 ** 15
+        self.header_size = (len(self.header()) + 11 + 63) // 64 * 64
+        self.count = 0
+        self.write_header()
+
+    def header(self):
+        descr = ", ".join(["('time', '<f8')"] +
+                          ["('%s', '%s')" % (c.name, c.npy_type) for c in self.columns])
+        return "{'descr': [%s], 'fortran_order': False, 'shape': (%d,), }" % (
+            descr, self.count)
+
+    def write_header(self):
+        header = self.header().ljust(self.header_size - 11) + "\n"
+        self.f.seek(0)
+        self.f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) +
+                     header.encode('ascii'))
+
+    def write(self, t, values):
+        self.f.write(struct.pack(self.format, t, *values))
+        self.count += 1
+
+    def close(self):
+        self.write_header()
+        self.f.close()
+
+
+def open_writer(filename, columns):
+    if filename.endswith(".npy"):
+        return NpyWriter(filename, columns)
+    return CsvWriter(filename, columns)
+
+
+def summary(ring, columns):
+    parts = ["%6d samples %7.1f/s" % (ring.count, ring.rate())]
+    for i, c in enumerate(columns):
+        parts.append("%s %d/%.1f/%d" % ((c.name,) + ring.stats(i)))
+    return "  ".join(parts)
+
+
+def record(dfu, registers, words, filename=None, count=None, duration=None,
+           ring_size=1000, interval=1.0, out=sys.stderr):
+    """Samples until count samples or duration seconds have been taken,
+    or until interrupted.  Returns the Ring of recent samples."""
+    sampler = Sampler(dfu, registers, words)
+    ring = Ring(sampler.columns, ring_size)
+    writer = None
+    if filename is not None:
+        writer = open_writer(filename, sampler.columns)
+    started = time.time()
+    shown = started
+    try:
+        while count is None or ring.count < count:
+            t, values = sampler.sample()
+            ring.append(t, values)
+            if writer is not None:
+                writer.write(t, values)
+            if t - shown >= interval:
+                shown = t
+                out.write("\r" + summary(ring, sampler.columns))
+                out.flush()
+            if duration is not None and t - started >= duration:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer is not None:
+            writer.close()
+    if ring.count:
+        out.write("\r" + summary(ring, sampler.columns) + "\n")
+    return ring
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Record C5000 registers and RAM words from an MD380')
+    parser.add_argument('--register', '-r', action='append', default=[],
+                        help='C5000 register to sample, may be repeated '
+                             '(default 0x43 and 0x44, the RSSI)')
+    parser.add_argument('--word', '-w', action='append', default=[],
+                        help='address of a 32-bit RAM word to sample, may be repeated')
+    parser.add_argument('--out', '-o', default=None,
+                        help='file to record to, .csv or .npy')
+    parser.add_argument('--count', '-n', type=int, default=None,
+                        help='stop after this many samples')
+    parser.add_argument('--duration', '-t', type=float, default=None,
+                        help='stop after this many seconds')
+    parser.add_argument('--ring', type=int, default=1000,
+                        help='samples kept for the rolling summary (default 1000)')
+    parser.add_argument('--sim', action='store_true',
+                        help='use md380_sim instead of a radio')
+    args = parser.parse_args()
+    registers = [int(r, 0) for r in args.register]
+    words = [int(w, 0) for w in args.word]
+    if not registers and not words:
+        registers = default_registers
+
+    try:
+        if args.sim:
+            import md380_sim
+            dfu = md380_tool.init_dfu(dev=md380_sim.SimulatedRadio())
+        else:
+            dfu = md380_tool.init_dfu()
+        record(dfu, registers, words, args.out, args.count, args.duration, args.ring)
+    except RuntimeError as e:
+        print(e.args[0])
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
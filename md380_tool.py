@@ -10,12 +10,12 @@
 # it water.
 from __future__ import print_function
 
-import json
+import datetime
+import os
 import struct
 import sys
 import time
-import usb.core
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 
 from DFU import DFU, Request, State
 
@@ -29,16 +29,56 @@ md380_vendor = 0x0483
 md380_product = 0xdf11
 
 
+# pyusb and json are imported by the commands that need them, so that
+# lookup, usage and the users of "from md380_tool import *" start fast.
+
+def usb_errors():
+    """usb.core.USBError once pyusb is loaded; before that nothing can
+    raise it, and the empty tuple catches nothing."""
+    usb_core = sys.modules.get('usb.core')
+    if usb_core is None:
+        return ()
+    return usb_core.USBError
+
+
 class UsersDB(object):
-    """List of registered DMR-MARC users."""
+    """List of registered DMR-MARC users.
+
+    Uses the memory-mapped index (user.idx and user.names, made by
+    md380-tool userdb) when there is one made from the same rows as
+    the CSV, else the CSV."""
     users = {}
 
     def __init__(self, filename=None):
+        """Names the database, which is loaded on the first lookup."""
+        if filename is None:
+            filename = sys.path[0] + '/user.bin'
+        self.filename = filename
+        self.index = None
+        self.loaded = False
+        self.cache = OrderedDict()
+
+    def load(self):
         """Loads the database."""
         import csv
+        self.loaded = True
+        filename = self.filename
         try:
-            if filename is None:
-                filename = sys.path[0] + '/user.bin'
+            index = os.path.splitext(filename)[0] + '.idx'
+            if filename.endswith('.idx'):
+                index = filename
+            if os.path.exists(index):
+                import md380_users
+                try:
+                    users = md380_users.IndexedUsers(index)
+                except ValueError:
+                    users = None  # an older index format, use the CSV
+                if users is not None:
+                    if (index == filename or not os.path.exists(filename) or
+                            users.extra == md380_users.fingerprint(filename)):
+                        self.index = users
+                        return
+                    users.close()
             with open(filename, 'rb') as csvfile:
                 reader = csv.reader(csvfile)
                 for row in reader:
@@ -48,10 +88,58 @@ class UsersDB(object):
             # print("WARNING: Unable to load user.bin.")
             pass
 
+    # Rows recently read from the index, most recent last.
+    cache_size = 4096
+
+    def finduser(self, id):
+        """Returns a user from the ID, or None if it's not known."""
+        if not self.loaded:
+            self.load()
+        if self.index is None:
+            return self.users.get(id)
+        cache = self.cache
+        row = cache.pop(id, cache)  # unknown IDs are cached as None
+        if row is cache:
+            row = self.index.get(id) or self.users.get(id)
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        cache[id] = row
+        return row
+
+    def findusers(self, key, prefix=True):
+        """Returns the users whose callsign or name is key, or starts
+        with it when prefix is set, ignoring case and spacing."""
+        if not self.loaded:
+            self.load()
+        if self.index is not None:
+            try:
+                return list(self.index.search(key, prefix))
+            except (IOError, OSError, ValueError):
+                pass  # no name index, search the rows instead
+        import md380_users
+        key = md380_users.normalize(key)
+        found = []
+        rows = self.users.values()
+        if self.index is not None:
+            rows = (self.index.row_at(i) for i in range(len(self.index)))
+        for row in rows:
+            keys = [md380_users.normalize(field) for field in row[1:3]]
+            if any(k.startswith(key) if prefix else k == key for k in keys):
+                found.append(row)
+        return found
+
+    def getusers(self, ids):
+        """Yields the user of each ID, as getuser() does."""
+        for id in ids:
+            yield self.getuser(id)
+
     def getuser(self, id):
         """Returns a user from the ID."""
         try:
-            return self.users[id]
+            row = self.finduser(id)
+            if row is None:
+                raise KeyError(id)
+            return row
         except:
             call = ""
             name = ""
@@ -71,10 +159,77 @@ class UsersDB(object):
             user[0]))
 
 
-# Quick to load, so might as well do it early.
+# Loaded on the first lookup.
 users = UsersDB()
 
 
+def lookuplines(lines, out=sys.stdout):
+    """Annotates lines of IDs or of logs: a line that is just an ID
+    becomes its username, as with lookup; elsewhere each number that
+    is a known ID gets the callsign and name added."""
+    import re
+    number = re.compile(r'\b\d{1,8}\b')
+
+    def annotate(m):
+        user = users.finduser(int(m.group(0)))
+        if user is None:
+            return m.group(0)
+        return "%s (%s %s)" % (m.group(0), user[1], user[2])
+
+    for line in lines:
+        stripped = line.strip()
+        if stripped.isdigit():
+            out.write(users.getusername(int(stripped)) + "\n")
+        else:
+            out.write(number.sub(annotate, line.rstrip("\r\n")) + "\n")
+        out.flush()
+
+
+# SMS storage in SPI Flash: 50 four byte headers, then 50 messages.
+inbox_address = 0x416d0
+sent_address = 0x45100
+message_count = 50
+message_size = 0x124
+message_region_size = message_count * 4 + message_count * message_size
+
+
+def parse_messages(data):
+    """Returns the non-deleted messages of a whole message region."""
+    data = memoryview(bytes(data))
+    messages = []
+    for i in range(0, message_count * 4, 4):
+        header = bytearray(data[i:i + 4])
+        if header[0] != 0x01:
+            continue  # deleted
+        message = {"deleted": False}
+        message["read"] = {0x1: True, 0x2: False}.get(header[1], "N/A")
+        message["order"] = header[2]
+        message["index"] = header[3]
+        start = message_count * 4 + message["index"] * message_size
+        body = data[start:start + message_size]
+        if len(body) < message_size:
+            continue  # index out of range
+        message["srcaddr"] = struct.unpack("<L", body[0:4].tobytes())[0] & 0xFFFFFF
+        message["flags"] = bytearray(body[4:5])[0]
+        message["text"] = body[4:].tobytes().decode('utf-16-le', 'replace').split(u'\0')[0]
+        messages.append(message)
+    return messages
+
+
+# Size of the applet's dmesg ring, DMESG_SIZE in applet/src/dmesg.h.
+dmesg_size = 1024
+
+lcd_width = 160
+lcd_height = 128
+
+
+def as_bytes(data):
+    """Command bytes of a Python 2 str, bytes or a Python 3 str."""
+    if isinstance(data, (bytes, bytearray)):
+        return bytearray(data)
+    return bytearray(data.encode('latin-1'))
+
+
 class Tool(DFU):
     """Client class for extra features patched into the MD380's firmware.
     None of this will work with the official firmware, of course."""
@@ -84,16 +239,20 @@ class Tool(DFU):
         # We need to read the manufacturer string to hook the added USB functions
         # Some systems (Raspian Jessie) don't have this property
         getattr(device, "manufacturer")
+        self.dmesg_buf = bytearray(dmesg_size)
+        # Whether the firmware has TDFU_C5000_READREGS, None until known.
+        self.c5000_readregs = None
+        # Whether the firmware has TDFU_SPIFLASHSTATUS, None until known.
+        self.spiflash_status = None
 
     def drawtext(self, str, a, b):
         """Sends a new MD380 command to draw text on the screen.."""
         cmd = 0x80  # Drawtext
         a = a & 0xFF
         b = b & 0xFF
-        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, chr(cmd) + chr(a) + chr(b) + self.widestr(str))
-        self.get_status()  # this changes state
-        time.sleep(0.1)
-        status = self.get_status()  # this gets the status
+        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0,
+                                   bytearray([cmd, a, b]) + as_bytes(self.widestr(str)))
+        status = self.wait_status()
         if status[2] == State.dfuDNLOAD_IDLE:
             if self.verbose:
                 print("Sent custom %02x %02x." % (a, b))
@@ -108,15 +267,13 @@ class Tool(DFU):
         # simple test - the firmware can also send larger tiles.
         nloops = 0
         while nloops<3:
-           cmdstr = (chr(0x84) + # TDFU_READ_FRAMEBUFFER
-                  chr(0) +    # x1 (x1,y1) = tile's upper left corner
-                  chr(y) +    # y1
-                  chr(159) +  # x2 (x2,y2) = tile's lower right corner
-                  chr(y)      # y2
-                  )
+           cmdstr = bytearray([0x84,  # TDFU_READ_FRAMEBUFFER
+                  0,    # x1 (x1,y1) = tile's upper left corner
+                  y,    # y1
+                  159,  # x2 (x2,y2) = tile's lower right corner
+                  y])   # y2
            self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, cmdstr)
-           self.get_status()  # this changes state
-           status = self.get_status()  # this gets the status
+           status = self.wait_status()
            # read 5-byte header (echo of cmdstr) followed by
            # 160 pixels per line * 3 bytes per pixel (BLUE,GREEN,RED):
            rd_result = self.upload(1, 160*3+5, 0);
@@ -126,121 +283,153 @@ class Tool(DFU):
            time.sleep(0.01)  # about 10 ms later
         return "" # error -> empty result
 
+    def read_framebuf_tile(self, x1, y1, x2, y2):
+        """Reads a rectangle of pixels from the framebuffer, 3 bytes
+        per pixel (BLUE,GREEN,RED), or returns None if the LCD was busy."""
+        w, h = 1 + x2 - x1, 1 + y2 - y1
+        cmdstr = bytearray([0x84, x1, y1, x2, y2])  # TDFU_READ_FRAMEBUFFER
+        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, cmdstr)
+        status = self.wait_status()
+        # The firmware echoes the coordinates only if it could read them.
+        rd_result = self.upload(1, 5 + 3 * w * h, 0)
+        if list(rd_result[1:5]) != [x1, y1, x2, y2]:
+            return None
+        return rd_result[5:]
+
     def send_keyboard_event(self, key_ascii, pressed_or_released ):
         """Sends a keyboard event to remotely control an MD380."""
-        cmdstr = ( chr(0x85) + # TDFU_REMOTE_KEY_EVENT
-                   key_ascii + # 2nd arg: single char 'M'(enu), 'U'(p), 'D'(own), 'B'(ack), etc
-                   chr(pressed_or_released) ) # 2nd arg: pressed (1) or released (0)
+        cmdstr = bytearray([0x85,  # TDFU_REMOTE_KEY_EVENT
+                   ord(key_ascii),  # 2nd arg: single char 'M'(enu), 'U'(p), 'D'(own), 'B'(ack), etc
+                   pressed_or_released])  # 3rd arg: pressed (1) or released (0)
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, cmdstr )
-        self.get_status()  # this changes state
-        time.sleep(0.05)
-        status = self.get_status()  # this gets the status
+        status = self.wait_status()
 
     def peek(self, adr, size):
         """Returns so many bytes from an address."""
         self.set_address(adr)
         return self.upload(1, size, 0)
 
+    # UPLOAD sizes tried by read_range(), largest first.  The block 1
+    # hook sends wLength bytes straight from the target address, so
+    # bigger chunks mean fewer set_address() round-trips.
+    read_chunk_sizes = [0x4000, 0x2000, 0x1000, 0x800, 0x400]
+    read_chunk_size = read_chunk_sizes[0]
+
+    def read_range(self, adr, length):
+        """Returns length bytes from an address as a bytearray.
+        The pointer is set once per chunk rather than once per 1kB, and
+        the chunk size shrinks until the firmware hands out full blocks."""
+        buf = bytearray()
+        while len(buf) < length:
+            size = min(self.read_chunk_size, length - len(buf))
+            try:
+                data = self.peek(adr + len(buf), size)
+            except usb_errors():
+                data = []
+                self.enter_dfu_mode()  # clears the stall
+            if len(data) == size:
+                buf.extend(data)
+            elif self.read_chunk_size > self.read_chunk_sizes[-1]:
+                smaller = [s for s in self.read_chunk_sizes
+                           if s < self.read_chunk_size]
+                self.read_chunk_size = smaller[0]
+                if self.verbose:
+                    print("Reading in 0x%x byte chunks." % self.read_chunk_size)
+            else:
+                raise RuntimeError("Read failed at 0x%08x." % (adr + len(buf)))
+        return buf
+
     def spiflashgetid(self):
         size = 4
         """Returns SPI Flash ID."""
         cmd = 0x05  # SPIFLASHGETID
-        cmdstr = (chr(cmd))
+        cmdstr = bytearray([cmd])
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0,
                                    cmdstr)
-        self.get_status()  # this changes state
-        status = self.get_status()  # this gets the status
+        status = self.wait_status()
         return self.upload(1, size, 0)
 
     def spiflashpeek(self, adr, size=1024):
         """Returns so many bytes from SPI Flash."""
         cmd = 0x01  # SPIFLASHREAD
-        cmdstr = (chr(cmd) +
-                  chr(adr & 0xFF) +
-                  chr((adr >> 8) & 0xFF) +
-                  chr((adr >> 16) & 0xFF) +
-                  chr((adr >> 24) & 0xFF)
-                  )
+        cmdstr = struct.pack("<BL", cmd, adr)
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0,
                                    cmdstr)
-        self.get_status()  # this changes state
-        status = self.get_status()  # this gets the status
+        status = self.wait_status()
         return self.upload(1, size, 0)
 
     def spiflash_erase64kblock(self, adr, size=1024):
         """Clear 64kb block on spi flash."""
         cmd = 0x03  # SPIFLASHWRITE
-        cmdstr = (chr(cmd) +
-                  chr(adr & 0xFF) +
-                  chr((adr >> 8) & 0xFF) +
-                  chr((adr >> 16) & 0xFF) +
-                  chr((adr >> 24) & 0xFF)
-                  )
+        cmdstr = struct.pack("<BL", cmd, adr)
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0,
                                    cmdstr)
-        self.get_status()  # this changes state
-        time.sleep(0.1)
+        status = self.wait_status()
+        buf = self.upload(1, size, 0)
+        self.spiflash_wait()
+        return buf
 
-        status = self.get_status()  # this gets the status
-        return self.upload(1, size, 0)
+    def spiflash_busy(self):
+        """Returns whether the SPI Flash is busy erasing or writing,
+        or None if the firmware can't tell."""
+        cmd = 0x06  # SPIFLASHSTATUS
+        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, bytearray([cmd]))
+        status = self.wait_status()
+        buf = self.upload(1, 2, 0)
+        if buf[0] != cmd:
+            return None  # older firmware ignores the command
+        return bool(buf[1] & 0x01)
+
+    def spiflash_wait(self, timeout=3.0):
+        """Waits for an erase to finish.  The chip ignores the next
+        erase while busy, and the firmware doesn't wait for it."""
+        if self.spiflash_status is not False:
+            deadline = time.time() + timeout
+            while True:
+                busy = self.spiflash_busy()
+                if busy is None:
+                    self.spiflash_status = False
+                    break
+                self.spiflash_status = True
+                if not busy:
+                    return
+                if time.time() > deadline:
+                    raise RuntimeError('SPI Flash still busy after %.1f s' % timeout)
+                time.sleep(0.01)
+        time.sleep(0.1)  # older firmware: give the erase time
 
     def spiflashpoke(self, adr, size, data):
         """Returns so many bytes from SPI Flash."""
         cmd = 0x04  # SPIFLASHWRITE_NEW
         # print(size)
-        cmdstr = (chr(cmd) +
-                  chr(adr & 0xFF) +
-                  chr((adr >> 8) & 0xFF) +
-                  chr((adr >> 16) & 0xFF) +
-                  chr((adr >> 24) & 0xFF) +
-                  chr(size & 0xFF) +
-                  chr((size >> 8) & 0xFF) +
-                  chr((size >> 16) & 0xFF) +
-                  chr((size >> 24) & 0xFF)
-                  )
-
-        for i in range(0, size, 1):
-            cmdstr = cmdstr + data[i]
+        cmdstr = struct.pack("<BLL", cmd, adr, size)
+
+        cmdstr = bytearray(cmdstr) + as_bytes(data[:size])
 
         # print(len(cmdstr))
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0,
                                    cmdstr)
-        self.get_status()  # this changes state
-        status = self.get_status()  # this gets the status
+        status = self.wait_status()
         # print(status)
         return self.upload(1, size, 0)
 
     def getinbox(self, address):
         """return non-deleted messages from inbox"""
-        buf = self.spiflashpeek(address, 50 * 4)
-        messages = []
-        for i in range(0, 50 * 4, 4):
-            message = {}
-            header = buf[i:i + 4]
-            message["deleted"] = (header[0]) != 0x01
-            if header[1] == 0x1:
-                message["read"] = True
-            elif header[1] == 0x2:
-                message["read"] = False
-            else:
-                message["read"] = "N/A"
-            message["order"] = (header[2])
-            message["index"] = (header[3])
-            if not message["deleted"]:
-                messages.append(message)
-        for message in messages:
-            message_bytes = self.spiflashpeek(address + 50 * 4 + message["index"] * 0x124, 50 * 4 + message["index"] * 0x124 + 0x124)
-            message["srcaddr"] = message_bytes[0] + (message_bytes[1] << 8) + (message_bytes[2] << 16)
-            message["flags"] = message_bytes[4]
-            message_text = ""
-            for i in range(4, 0x124, 2):
-                c = chr(message_bytes[i])
-                if c != '\0':
-                    message_text = message_text + c
-                else:
-                    break
-            message["text"] = message_text
-        return messages
+        # Read the headers, then only the 1024 byte chunks holding
+        # messages that are in use.
+        data = bytearray(message_region_size)
+        data[:1024] = self.spiflashpeek(address, 1024)
+        chunks = set()
+        for i in range(0, message_count * 4, 4):
+            if data[i] == 0x01:
+                start = message_count * 4 + data[i + 3] * message_size
+                for offset in range(start & ~1023, start + message_size, 1024):
+                    chunks.add(offset)
+        for offset in sorted(chunks - set([0])):
+            if offset < message_region_size:
+                chunk = self.spiflashpeek(address + offset, 1024)
+                data[offset:offset + 1024] = chunk[:message_region_size - offset]
+        return parse_messages(data)
 
     def getkey(self, index):
         """Returns an Enhanced Privacy key from SPI Flash.  1-indexed"""
@@ -251,35 +440,46 @@ class Tool(DFU):
     def c5000peek(self, reg):
         """Returns one byte from a C5000 register."""
         cmd = 0x11  # C5000 Read Reg
-        cmdstr = (chr(cmd) +
-                  chr(reg & 0xFF)
-                  )
+        cmdstr = bytearray([cmd, reg & 0xFF])
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0,
                                    cmdstr)
-        self.get_status()  # this changes state
-        status = self.get_status()  # this gets the status
+        status = self.wait_status()
         buf = self.upload(1, 1024, 0)  # Peek the 1024 byte dmesg buffer.
         return buf[0]
 
+    def c5000_snapshot(self, regs):
+        """Returns a {register: value} dict of C5000 registers, read
+        in one transaction when the firmware supports it."""
+        regs = sorted(set(r & 0xFF for r in regs))
+        if not regs:
+            return {}
+        if self.c5000_readregs is not False:
+            first, count = regs[0], regs[-1] - regs[0] + 1
+            cmd = 0x12  # C5000 Read Regs
+            self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0,
+                                       bytearray([cmd, first, count]))
+            status = self.wait_status()
+            buf = self.upload(1, 3 + count, 0)
+            if buf[0] == cmd and buf[1] == first and buf[2] == count:
+                self.c5000_readregs = True
+                return dict((r, buf[3 + r - first]) for r in regs)
+            # Older firmware ignores the command.
+            self.c5000_readregs = False
+        return dict((r, self.c5000peek(r)) for r in regs)
+
     def c5000poke(self, reg, val):
         """Writes a byte into a C5000 register."""
         cmd = 0x10  # C5000 Write Reg
-        cmdstr = (chr(cmd) +
-                  chr(reg & 0xFF) +
-                  chr(val & 0xFF)
-                  )
+        cmdstr = bytearray([cmd, reg & 0xFF, val & 0xFF])
         self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0,
                                    cmdstr)
-        self.get_status()  # this changes state
-        status = self.get_status()  # this gets the status
+        status = self.wait_status()
 
     def custom(self, cmd):
         """Returns the 1024 byte DMESG buffer."""
 
-        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, chr(cmd))
-        self.get_status()  # this changes state
-        # time.sleep(0.1);
-        status = self.get_status()  # this gets the status
+        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, bytearray([cmd]))
+        status = self.wait_status()
 
     def reboot_to_bootloader(self):
         """Reboot into the bootloader with a DFU command.
@@ -287,37 +487,31 @@ class Tool(DFU):
         so you must reprogram the firmware afterwards if you'd like a working radio.
         """
         cmd = 0x86  # reboot_to_bootloader
-        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, chr(cmd))
+        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, bytearray([cmd]))
         self.get_status()  # this changes state
 
     def getdmesg(self):
         """Returns the 1024 byte DMESG buffer."""
         cmd = 0x00  # DMESG
-        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, chr(cmd))
-        self.get_status()  # this changes state
-        # time.sleep(0.1);
-        status = self.get_status()  # this gets the status
-        buf = self.upload(1, 1024, 0)  # Peek the 1024 byte dmesg buffer.
+        self._device.ctrl_transfer(0x21, Request.DNLOAD, 1, 0, bytearray([cmd]))
+        status = self.wait_status()
+        buf = self.dmesg_buf
+        buf[:] = self.upload(1, dmesg_size, 0)  # Peek the 1024 byte dmesg buffer.
 
         # Okay, so at this point we have the buffer, but it's a ring
         # buffer that might have already looped, so we need to reorder
         # if that is the case or crop it if it isn't.
-        tail = ""
-        head = None
-        for b in buf:
-            if head is None:
-                if b > 0:
-                    tail += chr(b)
-                else:
-                    head = ""
-            else:
-                if b > 0:
-                    head += chr(b)
-                else:
-                    break
-        if head is None:
-            return tail
-        return head + tail
+        end = buf.find(b'\0')
+        if end < 0:
+            data = bytes(buf)
+        else:
+            head_end = buf.find(b'\0', end + 1)
+            if head_end < 0:
+                head_end = len(buf)
+            data = bytes(buf[end + 1:head_end] + buf[:end])
+        if str is bytes:
+            return data
+        return data.decode('latin-1')
 
     def parse_calibration_data(self, data):
 
@@ -350,53 +544,87 @@ class Tool(DFU):
             freqs.append(Frequency._asdict(Frequency._make((rx_freq, tx_freq) + struct.unpack("B" * 35, codes))))
         return freqs
 
-
-# def calllog(dfu):
-#     """Prints a call log to stdout, fetched from the MD380's memory."""
-#     dfu.drawtext("Hooking calls!",160,50);
-#
-#     #Set the target address to the list of DMR addresses.
-#     dfu.set_address(0x2001d098);
-#     old1=0;
-#     old2=0;
-#     while 1:
-#         data=dfu.upload(1,16,0);#Peek sixteen bytes.
-#         llid0=(data[0]+
-#                (data[1]<<8)+
-#                (data[2]<<16)+
-#                (data[3]<<24));
-#         llid1=(data[4]+
-#                (data[5]<<8)+
-#                (data[6]<<16)+
-#                (data[7]<<24));
-#         llid2=(data[8]+
-#                (data[9]<<8)+
-#                (data[10]<<16)+
-#                (data[11]<<24));
-#         if old1!=llid1 or old2!=llid2:
-#             old1=llid1;
-#             old2=llid2;
-#             print("DMR call from %s to %s." % (
-#                 users.getusername(llid1), users.getusername(llid2)))
-#             #get actual canel name
-#             dfu.set_address(0x2001c9d4);
-#             data=dfu.upload(1,32,0);
-#             message=""
-#             for i in range(0,32,2):
-#                c=chr(data[i]&0x7F);
-#                if c!='\0':
-#                   message=message+c;
-#             print(message)
-#             #get actual zone name
-#             dfu.set_address(0x2001b958);
-#             data=dfu.upload(1,32,0);
-#             message=""
-#             for i in range(0,32,2):
-#                c=chr(data[i]&0x7F);
-#                if c!='\0':
-#                  message=message+c;
-#             print(message)
-#             sys.stdout.flush();
+    def read_calibration(self):
+        """Returns the parsed calibration data.  Selecting it and reading
+        it is one method, so that the daemon runs nothing in between."""
+        self.md380_custom(0xA2, 0x05)
+        return self.parse_calibration_data(str(bytearray(self.upload(0, 512))))
+
+
+# Call state and names in RAM, for 2.032.
+call_state_address = 0x2001d098  # three u32 DMR IDs, the last two are source and destination
+channel_name_address = 0x2001c9d4  # 16 UTF-16 characters
+zone_name_address = 0x2001b958  # 16 UTF-16 characters
+
+# Column names of the user database rows.
+user_fields = ("id", "callsign", "name", "city", "state", "nickname", "country")
+
+
+def utf16_name(data):
+    """Decodes a zero terminated UTF-16 name from memory."""
+    return bytes(bytearray(data)).decode('utf-16-le', 'replace').split(u'\0')[0]
+
+
+class CallLog(object):
+    """Turns the radio's call state into events.
+
+    Every poll reads the call state words in one peek.  The channel and
+    zone names are read again only every name_interval seconds and are
+    otherwise taken from the cache, with a "channel" event when they
+    change."""
+
+    def __init__(self, dfu, users, name_interval=1.0):
+        self.dfu = dfu
+        self.users = users
+        self.name_interval = name_interval
+        self.call = None
+        self.channel = None
+        self.zone = None
+        self.names_read = 0
+
+    def user(self, id):
+        user = dict(zip(user_fields, self.users.getuser(id)))
+        user["id"] = id
+        return user
+
+    def poll(self):
+        """Returns a list of new event dicts."""
+        events = []
+        now = time.time()
+        if now - self.names_read >= self.name_interval:
+            self.names_read = now
+            channel = utf16_name(self.dfu.peek(channel_name_address, 32))
+            zone = utf16_name(self.dfu.peek(zone_name_address, 32))
+            if (channel, zone) != (self.channel, self.zone):
+                self.channel, self.zone = channel, zone
+                events.append({"event": "channel", "channel": channel, "zone": zone})
+        data = bytearray(self.dfu.peek(call_state_address, 12))
+        call = struct.unpack("<LL", bytes(data[4:12]))
+        if call != self.call:
+            self.call = call
+            src, dst = call
+            if src != 0:  # 0 while nobody has been heard
+                events.append({"event": "call",
+                               "src": self.user(src), "dst": dst,
+                               "channel": self.channel, "zone": self.zone})
+        stamp = datetime.datetime.fromtimestamp(now).isoformat()
+        for event in events:
+            event["time"] = stamp
+        return events
+
+    def run(self, out=sys.stdout, interval=0.05):
+        import json
+        while True:
+            started = time.time()
+            for event in self.poll():
+                out.write(json.dumps(event, sort_keys=True) + "\n")
+                out.flush()
+            time.sleep(max(0, interval - (time.time() - started)))
+
+
+def calllog(dfu):
+    """Prints call events as JSON lines, fetched from the MD380's memory."""
+    CallLog(dfu, users).run()
 
 
 def dmesg(dfu):
@@ -405,53 +633,228 @@ def dmesg(dfu):
     print(dfu.getdmesg())
 
 def parse_calibration(dfu):
-    dfu.md380_custom(0xA2, 0x05)
-    data = str(bytearray(dfu.upload(0, 512)))
-    freqs = dfu.parse_calibration_data(data)
+    import json
+    freqs = dfu.read_calibration()
     print(json.dumps(freqs, indent=4))
 
 
 def coredump(dfu, filename):
     """Dumps a corefile of RAM."""
     with open(filename, 'wb') as f:
-        for adr in range(0x20000000,
-                         0x20000000 + (128 * 1024),
-                         1024):
-            # print("Fetching %08x" % adr)
-            buf = dfu.peek(adr, 1024)
-            f.write(buf)
+        f.write(dfu.read_range(0x20000000, 128 * 1024))
         f.close()
 
+def framebuf_tile_size(width=lcd_width, height=lcd_height, limit=dmesg_size - 5):
+    """Returns the (w, h) tile that covers the screen in the fewest
+    reads, each at most limit bytes of pixels.  The firmware puts a
+    five byte header in front of the pixels in the DMESG_SIZE buffer."""
+    best = None
+    for w in range(1, width + 1):
+        h = min(height, limit // (3 * w))
+        if h == 0:
+            break
+        tiles = -(-width // w) * -(-height // h)
+        if best is None or tiles <= best[0]:  # wider tiles on a tie
+            best = (tiles, w, h)
+    return best[1], best[2]
+
+
+def framebuf_tiles():
+    """Returns the (x1, y1, x2, y2) tiles covering the screen."""
+    w, h = framebuf_tile_size()
+    return [(x, y, min(x + w, lcd_width) - 1, min(y + h, lcd_height) - 1)
+            for y in range(0, lcd_height, h) for x in range(0, lcd_width, w)]
+
+
+def read_framebuf_tiles(dfu, frame, tiles, retries=20, between=None):
+    """Reads tiles into frame, returning those whose pixels changed.
+    Tiles the LCD was too busy for are read again after the others,
+    a few milliseconds later.  between, if given, is called before
+    each tile, to let other commands use the link."""
+    stride = lcd_width * 3
+    changed = []
+    for attempt in range(retries):
+        failed = []
+        for tile in tiles:
+            if between is not None:
+                between()
+            x1, y1, x2, y2 = tile
+            pixels = dfu.read_framebuf_tile(x1, y1, x2, y2)
+            if pixels is None:
+                failed.append(tile)
+                continue
+            pixels = bytearray(pixels)
+            row = 3 * (1 + x2 - x1)
+            dirty = False
+            for i, y in enumerate(range(y1, y2 + 1)):
+                start = y * stride + 3 * x1
+                line = pixels[i * row:(i + 1) * row]
+                if frame[start:start + row] != line:
+                    frame[start:start + row] = line
+                    dirty = True
+            if dirty:
+                changed.append(tile)
+        if not failed:
+            return changed
+        tiles = failed
+        time.sleep(0.01)
+    raise RuntimeError('LCD stayed busy for %d tiles' % len(tiles))
+
+
+def read_framebuf(dfu, retries=20):
+    """Returns the whole framebuffer, top line first, 3 bytes per pixel
+    (BLUE,GREEN,RED)."""
+    frame = bytearray(lcd_width * 3 * lcd_height)
+    read_framebuf_tiles(dfu, frame, framebuf_tiles(), retries)
+    return frame
+
+
+def write_bmp(f, frame, width=lcd_width, height=lcd_height):
+    """Writes BGR pixels, top line first, as a 24 bit BMP."""
+    stride = width * 3
+    padding = -stride % 4
+    size = (stride + padding) * height
+    f.write(b"BM" + struct.pack("<LHHL", 54 + size, 0, 0, 54))
+    f.write(struct.pack("<LllHHLLllLL", 40, width, height, 1, 24, 0, size, 0, 0, 0, 0))
+    for y in range(height - 1, -1, -1):  # bmp files begin with the bottom line
+        f.write(bytes(frame[y * stride:(y + 1) * stride]) + b"\0" * padding)
+
+
+def bgr_to_rgb(frame):
+    rgb = bytearray(frame)
+    rgb[0::3], rgb[2::3] = frame[2::3], frame[0::3]
+    return rgb
+
+
+def write_png(f, frame, width=lcd_width, height=lcd_height):
+    """Writes BGR pixels, top line first, as an RGB PNG."""
+    import zlib
+
+    def chunk(kind, data):
+        return (struct.pack(">L", len(data)) + kind + data +
+                struct.pack(">L", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    rgb = bgr_to_rgb(frame)
+    stride = width * 3
+    raw = b"".join(b"\0" + bytes(rgb[y * stride:(y + 1) * stride]) for y in range(height))
+    f.write(b"\x89PNG\r\n\x1a\n")
+    f.write(chunk(b"IHDR", struct.pack(">LLBBBBB", width, height, 8, 2, 0, 0, 0)))
+    f.write(chunk(b"IDAT", zlib.compress(raw, 9)))
+    f.write(chunk(b"IEND", b""))
+
+
 def screenshot(dfu, filename="screenshot.bmp"):
-    """Reads the LCD framebuffer"""
+    """Reads the LCD framebuffer into a .bmp or .png file."""
+    frame = read_framebuf(dfu)
     with open(filename, 'wb') as f:
-      # Write a simple, hard-coded bitmap file header
-      #  (14 byte "file header" + 40 byte "info block" + 3*160*128 byte "data",
-      #   total size = 0x0000F036 bytes. Here written in little endian format:
-      f.write( "BM" + chr(0x36)+chr(0xF0)+chr(0x00)+chr(0x00)
-                    + chr(0x00)+chr(0x00)+chr(0x00)+chr(0x00)
-                    + chr( 54 )+chr(0x00)+chr(0x00)+chr(0x00) )
-      # Next: Write the "bitmap info header". Keep it simple, use 40 bytes.
-      f.write( chr( 40 )+chr(0x00)+chr(0x00)+chr(0x00) ) # sizeof(BITMAPINFOHEADER)
-      f.write( chr( 160)+chr(0x00)+chr(0x00)+chr(0x00) ) # width (pixel)
-      f.write( chr( 128)+chr(0x00)+chr(0x00)+chr(0x00) ) # height (pixel)
-      f.write( chr( 1  )+chr(0x00) ) # number of bitplanes (anachronism)
-      f.write( chr( 24 )+chr(0x00) ) # number of bits per pixel
-      f.write( chr(0x00)+chr(0x00)+chr(0x00)+chr(0x00) ) # no compression
-      f.write( chr(0x00)+chr(0xA0)+chr(0x00)+chr(0x00) ) # sizeof(pixel data)
-      f.write( chr(0x00)+chr(0x00)+chr(0x00)+chr(0x00) ) # X pixel per meter
-      f.write( chr(0x00)+chr(0x00)+chr(0x00)+chr(0x00) ) # P pixel per meter
-      f.write( chr(0x00)+chr(0x00)+chr(0x00)+chr(0x00) ) # no colour palette
-      f.write( chr(0x00)+chr(0x00)+chr(0x00)+chr(0x00) ) # number of colours "used" : 0 = all
-      # Write image data with 160 pixels per line, 3 bytes per pixel.
-      # For a start, just dump the pixels to the file unmodified.
-      y = 127; # bmp files begin with the 'bottom line' (y=127)
-      while y>=0:
-        buf = dfu.read_framebuf_line(y)
-        f.write(buf)
-        y = y-1;
-      f.close()
-
+        if filename.lower().endswith(".png"):
+            write_png(f, frame)
+        else:
+            write_bmp(f, frame)
+
+
+class ScreenStream(object):
+    """Follows the screen, reading the tiles that are changing on
+    every frame and the quiet ones in rotation.
+
+    A tile that changed stays hot, read on every frame, for
+    hot_frames frames.  Of the other tiles, scan_tiles are read per
+    frame, so every change is noticed within a few frames while a
+    still screen costs only a handful of reads per frame.
+
+    When a quiet tile changes, or at least full_refresh tiles do, the
+    screen is changing as a whole (a new menu, say), and the rest of
+    the tiles are read in the same frame, so no frame shows half of
+    the old screen.  between is passed on to read_framebuf_tiles()."""
+
+    def __init__(self, dfu, hot_frames=10, scan_tiles=8, full_refresh=8, between=None):
+        self.dfu = dfu
+        self.between = between
+        self.tiles = framebuf_tiles()
+        self.frame = bytearray(lcd_width * 3 * lcd_height)
+        self.hot_frames = hot_frames
+        self.scan_tiles = scan_tiles
+        self.full_refresh = full_refresh
+        self.hot = {}  # tile -> frames left hot
+        self.scan = 0
+        self.count = 0
+        self.reads = 0
+
+    def next(self):
+        """Updates the frame, returning True if any pixel changed."""
+        if self.count == 0:
+            wanted = self.tiles
+        else:
+            wanted = [t for t in self.tiles if t in self.hot]
+            cold = [t for t in self.tiles if t not in self.hot]
+            for i in range(min(self.scan_tiles, len(cold))):
+                wanted.append(cold[(self.scan + i) % len(cold)])
+            self.scan += self.scan_tiles
+        changed = read_framebuf_tiles(self.dfu, self.frame, wanted, between=self.between)
+        self.reads += len(wanted)
+        if len(wanted) < len(self.tiles) and (
+                len(changed) >= self.full_refresh or
+                any(t not in self.hot for t in changed)):
+            rest = [t for t in self.tiles if t not in wanted]
+            changed += read_framebuf_tiles(self.dfu, self.frame, rest, between=self.between)
+            self.reads += len(rest)
+        for tile in list(self.hot):
+            self.hot[tile] -= 1
+            if self.hot[tile] <= 0:
+                del self.hot[tile]
+        for tile in changed:
+            self.hot[tile] = self.hot_frames
+        self.count += 1
+        return bool(changed)
+
+    def run(self, output, fps=10.0, frames=None, report=sys.stderr):
+        """Writes frames to output at up to fps frames per second.
+
+        For "-" or a .rgb file every frame is written as raw RGB24 (for
+        ffmpeg -f rawvideo -pix_fmt rgb24 -s 160x128); for a pattern
+        like frame%05d.png or frame%05d.bmp only changed frames are
+        written, numbered by frame; a name without % is overwritten
+        with each changed frame.  The achieved rate is reported once a
+        second."""
+        raw = output == "-" or output.endswith(".rgb")
+        if raw:
+            out = sys.stdout if output == "-" else open(output, 'wb')
+        elif "%" in output:
+            try:
+                output % 0
+            except (TypeError, ValueError):
+                raise RuntimeError('Bad file name pattern %s, use one like frame%%05d.png' % output)
+        shown = started = time.time()
+        shown_count = shown_reads = 0
+        try:
+            while frames is None or self.count < frames:
+                t = time.time()
+                changed = self.next()
+                if raw:
+                    out.write(bytes(bgr_to_rgb(self.frame)))
+                    out.flush()
+                elif changed:
+                    name = output % self.count if "%" in output else output
+                    with open(name, 'wb') as f:
+                        if output.lower().endswith(".png"):
+                            write_png(f, self.frame)
+                        else:
+                            write_bmp(f, self.frame)
+                now = time.time()
+                if report is not None and now - shown >= 1.0:
+                    n = self.count - shown_count
+                    report.write("%.1f fps, %.1f tiles per frame\n" % (
+                        n / (now - shown), float(self.reads - shown_reads) / n))
+                    report.flush()
+                    shown, shown_count, shown_reads = now, self.count, self.reads
+                time.sleep(max(0, 1.0 / fps - (now - t)))
+        finally:
+            if raw and out is not sys.stdout:
+                out.close()
+
+
+def stream(dfu, output, fps=10.0):
+    ScreenStream(dfu).run(output, fps)
 
 
 def hexdump(dfu, address, length=512):
@@ -476,10 +879,25 @@ def hexdump(dfu, address, length=512):
 
 
 def hexwatch(dfu, address):
-    """Dumps from memory to the screen"""
-    while True:
-        hexdump(dfu, address, 16)
-        time.sleep(0.05)
+    """Prints 16 bytes of memory whenever they change."""
+    watch(dfu, ["%s=0x%x:16" % (address, int(address, 16))])
+
+
+def watch(dfu, specs):
+    """Prints the changes of memory regions, named by symbols from the
+    files in $MD380_SYMBOLS, to the screen or to $MD380_WATCH_LOG."""
+    import md380_watch
+    symbols = {}
+    for filename in os.environ.get('MD380_SYMBOLS', '').split(os.pathsep):
+        if filename:
+            md380_watch.load_symbols(filename, symbols)
+    regions = [md380_watch.parse_region(spec, symbols) for spec in specs]
+    log = os.environ.get('MD380_WATCH_LOG')
+    if log is None:
+        md380_watch.Watch(dfu, regions).run()
+    else:
+        with open(log, 'a') as f:
+            md380_watch.Watch(dfu, regions).run(f)
 
 
 def dump(dfu, filename, address):
@@ -516,12 +934,7 @@ def flashgetid(dfu):
 def flashdump(dfu, filename):
     """Dumps flash."""
     with open(filename, 'wb') as f:
-        for adr in range(0x08000000,
-                         0x08000000 + (1024 * 1024),
-                         1024):
-            # print("Fetching %08x" % adr)
-            buf = dfu.peek(adr, 1024)
-            f.write(buf)
+        f.write(dfu.read_range(0x08000000, 1024 * 1024))
         f.close()
 
 
@@ -546,7 +959,7 @@ def spiflashwrite(dfu, filename, adr):
             dfu.md380_custom(0x91, 0x01)  # disable any radio and UI events
             # while on spi flash
             print("erase %d bytes @ 0x%x" % (size, adr))
-            for n in range(adr, adr + size + 1, 0x1000):
+            for n in range(adr & ~0xFFFF, adr + size, 0x10000):
                 # print("erase %x " % n)
                 dfu.spiflash_erase64kblock(n)
             fullparts = int(size / 1024)
@@ -567,26 +980,167 @@ def spiflashwrite(dfu, filename, adr):
         sys.stdout.write("can't programm spi flash wrong flash type\n")
 
 
-def dmesgfasttail(dfu):
-    """Keeps printing the dmesg buffer."""
-    while True:
-        sys.stdout.write(dfu.getdmesg())
-        # time.sleep(0.1);
+def spiflashupdate(dfu, filename, adr, manifest=None):
+    """Programm SPI Flash, erasing and writing only what changed.
+
+    The image is padded with 0xFF to whole 64kB blocks, which is what a
+    full spiflashwrite leaves behind.  Each block is compared against the
+    per-block hashes in the manifest file from the last update, or against
+    a read-back when there is no manifest.  Changed blocks are erased once
+    and their non-blank pages programmed.  When a read-back shows that a
+    block only needs bits cleared, the changed pages are programmed
+    without an erase."""
+    import hashlib
+    import json
+    block_size = 0x10000
+    page_size = 1024
+    if flashgetid(dfu) != 16 * 1024 * 1024:
+        sys.stdout.write("can't programm spi flash wrong flash type\n")
+        return
+    with open(filename, 'rb') as f:
+        data = bytearray(f.read())
+    start = adr & ~(block_size - 1)
+    end = (adr + len(data) + block_size - 1) & ~(block_size - 1)
+    image = bytearray(b'\xff' * (end - start))
+    image[adr - start:adr - start + len(data)] = data
+
+    hashes = {}
+    if manifest is not None:
+        try:
+            with open(manifest, 'r') as f:
+                hashes = json.load(f)["blocks"]
+        except (IOError, ValueError, KeyError):
+            print("No usable manifest in %s, reading back instead." % manifest)
+
+    dfu.md380_custom(0x91, 0x01)  # disable any radio and UI events
+    erased = programmed = 0
+    for block in range(start, end, block_size):
+        new = image[block - start:block - start + block_size]
+        digest = hashlib.sha1(new).hexdigest()
+        old = None
+        if "%x" % block in hashes:
+            if hashes["%x" % block] == digest:
+                continue
+        else:
+            old = bytearray()
+            for n in range(block, block + block_size, page_size):
+                old.extend(dfu.spiflashpeek(n, page_size))
+            if old == new:
+                hashes["%x" % block] = digest
+                continue
+
+        pages = []
+        need_erase = old is None
+        for n in range(0, block_size, page_size):
+            page = new[n:n + page_size]
+            if old is not None and old[n:n + page_size] == page:
+                continue
+            if old is not None and any(o & b != b for o, b in zip(old[n:n + page_size], page)):
+                need_erase = True
+            pages.append(n)
+        if need_erase:
+            dfu.spiflash_erase64kblock(block)
+            erased += 1
+            pages = [n for n in range(0, block_size, page_size)
+                     if new[n:n + page_size] != b'\xff' * page_size]
+        for n in pages:
+            dfu.spiflashpoke(block + n, page_size, bytes(new[n:n + page_size]))
+            programmed += 1
+        hashes["%x" % block] = digest
+        sys.stdout.write('.')
         sys.stdout.flush()
 
+    print()
+    print("erased %d of %d blocks, programmed %d pages @ 0x%x" % (
+        erased, (end - start) // block_size, programmed, start))
+    if manifest is not None:
+        with open(manifest, 'w') as f:
+            json.dump({"address": start, "block_size": block_size,
+                       "blocks": hashes}, f, indent=1, sort_keys=True)
+    sys.stdout.write("reboot radio now\n")
+    dfu.md380_reboot()
+
+
+class DmesgTail(object):
+    """Follows the dmesg ring, returning only the text that is new
+    since the last poll.
+
+    The patched firmware empties the ring after each upload, so
+    every read is new text.  Builds that keep the ring are handled
+    too: the text seen last time is cut off the front of each read.
+    Which kind of firmware this is gets found out from two reads in a
+    row the first time there is text."""
+
+    def __init__(self, dfu, interval_min=0.01, interval_max=0.5):
+        self.dfu = dfu
+        self.seen = ""
+        self.flushes = None
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.interval = interval_max
+
+    def poll(self):
+        """Returns the new dmesg text, possibly an empty string."""
+        text = self.dfu.getdmesg()
+        if self.flushes is None:
+            if not text:
+                return text
+            again = self.dfu.getdmesg()
+            self.flushes = not again.startswith(text)
+            if self.flushes:
+                new = text + again
+            else:
+                new = text = again
+        elif self.flushes:
+            new = text
+        elif text.startswith(self.seen):
+            new = text[len(self.seen):]
+        elif len(text) >= dmesg_size - 1:
+            # The ring wrapped; find where the old text ends in it.
+            k = min(len(self.seen), len(text))
+            while k > 0 and not text.startswith(self.seen[-k:]):
+                k -= 1
+            new = text[k:]
+        else:
+            new = text  # the ring was cleared
+        if not self.flushes:
+            self.seen = text
+        self.adapt(len(new))
+        return new
+
+    def adapt(self, size):
+        """Polls faster while the log is growing, so that the ring
+        never fills up between two reads, and slower while it's idle."""
+        if size > dmesg_size // 4:
+            self.interval = max(self.interval_min, self.interval / 2)
+        elif size == 0:
+            self.interval = min(self.interval_max, self.interval * 1.5)
+
+    def follow(self, out=sys.stdout, sleep=True):
+        while True:
+            new = self.poll()
+            if new:
+                out.write(new)
+                out.flush()
+            if sleep:
+                time.sleep(self.interval)
+
+
+def dmesgfasttail(dfu):
+    """Keeps printing new dmesg text, polling without pause."""
+    DmesgTail(dfu).follow(sleep=False)
+
 
 def dmesgtail(dfu):
-    """Keeps printing the dmesg buffer."""
-    while True:
-        sys.stdout.write(dfu.getdmesg())
-        time.sleep(0.1)
-        sys.stdout.flush()
+    """Keeps printing new dmesg text, polling as fast as the log grows."""
+    DmesgTail(dfu).follow()
 
 
 def c5000(dfu):
     """Prints some DMR registers."""
+    regs = dfu.c5000_snapshot(range(0, 0x87))
     for r in range(0, 0x87):
-        sys.stdout.write("[0x%02x]=0x%02x\t" % (r, dfu.c5000peek(r)))
+        sys.stdout.write("[0x%02x]=0x%02x\t" % (r, regs[r]))
         if r % 4 == 3:
             sys.stdout.write("\n")
             sys.stdout.flush()
@@ -596,23 +1150,51 @@ def c5000(dfu):
 def rssi(dfu):
     """Graphs the RSSI value.  Kinda useless."""
     while True:
-        rssih = dfu.c5000peek(0x43)
-        rssil = dfu.c5000peek(0x44)
-        rssi = (rssih << 8) | rssil
+        regs = dfu.c5000_snapshot([0x43, 0x44])
+        rssi = (regs[0x43] << 8) | regs[0x44]
         print("%04x" % rssi)
         time.sleep(0.25)
 
 
+def getmessages(dfu):
+    """Returns the inbox and sent messages, oldest first, with the
+    names of their senders or recipients."""
+    folders = {}
+    for folder, address in (("inbox", inbox_address), ("sent", sent_address)):
+        folders[folder] = dfu.getinbox(address)[::-1]
+        for msg in folders[folder]:
+            msg["name"] = users.getusername(msg["srcaddr"])
+    return folders
+
+
 def messages(dfu):
     """Prints all the SMS messages."""
+    folders = getmessages(dfu)
     print("Inbox:")
-    messages = dfu.getinbox(0x416d0)[::-1]
-    for msg in messages:
-        print("From: %s Text: %s" % (msg["srcaddr"], msg["text"]))
+    for msg in folders["inbox"]:
+        print("From: %s Text: %s" % (msg["srcaddr"], msg["text"].encode('utf-8')))
     print("Sent:")
-    messages = dfu.getinbox(0x45100)[::-1]
-    for msg in messages:
-        print("To  : %s Text: %s" % (msg["srcaddr"], msg["text"]))
+    for msg in folders["sent"]:
+        print("To  : %s Text: %s" % (msg["srcaddr"], msg["text"].encode('utf-8')))
+
+
+def exportmessages(dfu, filename):
+    """Writes all the SMS messages to a .json or .csv file."""
+    import json
+    folders = getmessages(dfu)
+    if filename.endswith(".csv"):
+        import csv
+        fields = ["folder", "order", "srcaddr", "name", "read", "flags", "text"]
+        with open(filename, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for folder in ("inbox", "sent"):
+                for msg in folders[folder]:
+                    msg["folder"] = folder
+                    writer.writerow([unicode(msg[k]).encode('utf-8') for k in fields])
+    else:
+        with open(filename, 'w') as f:
+            json.dump(folders, f, indent=1, sort_keys=True)
 
 
 def keys(dfu):
@@ -650,8 +1232,7 @@ def bcd(b):
 
 def calldate(dfu):
     """Print Time and Date  to stdout, fetched from the MD380's RTC."""
-    dfu.set_address(0x40002800)  # 2.032
-    data = dfu.upload(1, 8, 0)
+    data = dfu.peek(0x40002800, 8)  # 2.032
 
     print("%02d.%02d.%02d %02d:%02d:%02d" % (
         bcd(data[4] & (0x0f | 0x30)),
@@ -679,8 +1260,7 @@ def calldate(dfu):
 
 def readword(dfu, address):
     print("%x" % (int(address, 0)))
-    dfu.set_address(int(address, 0))  # 2.032
-    data = dfu.upload(1, 4 * 4, 0)
+    data = dfu.peek(int(address, 0), 4 * 4)  # 2.032
     print("%x %02x%02x%02x%02x" % (int(address, 0), data[3], data[2], data[1], data[0]))
     print("%x %02x %02x %02x %02x" % (int(address, 0), data[3], data[2], data[1], data[0]))
     print("%x %02x %02x %02x %02x" % (int(address, 0) + 4, data[7], data[6], data[5], data[4]))
@@ -689,9 +1269,19 @@ def readword(dfu, address):
     print("%d" % (data[3] << 24 | data[2] << 16 | data[1] << 8 | data[0]))
 
 
-def init_dfu(alt=0):
-    dev = usb.core.find(idVendor=md380_vendor,
-                        idProduct=md380_product)
+def init_dfu(alt=0, dev=None):
+    if dev is None:
+        # Hand the work to a running md380-tool daemon, if there is one.
+        import md380_daemon
+        import socket
+        if hasattr(socket, 'AF_UNIX') and md380_daemon.trusted(md380_daemon.socket_path()):
+            try:
+                return md380_daemon.Client()
+            except socket.error:
+                pass
+        import usb.core
+        dev = usb.core.find(idVendor=md380_vendor,
+                            idProduct=md380_product)
 
     if dev is None:
         raise RuntimeError('Device not found')
@@ -702,7 +1292,7 @@ def init_dfu(alt=0):
     try:
         dfu.enter_dfu_mode()
         pass
-    except usb.core.USBError as e:
+    except usb_errors() as e:
         if len(e.args) > 0 and e.args[0] == 'Pipe error':
             raise RuntimeError('Failed to enter DFU mode. Is bootloader running?')
         else:
@@ -715,25 +1305,40 @@ def usage():
     print("""
 Usage: md380-tool <command> <arguments>
 
-Looks up the name by an ID number.
+Looks up the name by an ID number, or every ID in a file or stdin,
+one ID per line or as part of log lines.
     md380-tool lookup 12345
+    md380-tool lookup <ids.txt|->
+Finds users by the start of their callsign or name.
+    md380-tool find <callsign-prefix>
+Builds the indexed user database that lookups use when it exists,
+user.idx and user.names next to md380-tool unless another file is given.
+    md380-tool userdb <user.bin|db/stripped.csv> [user.idx]
 
 Prints the dmesg buffer.
     md380-tool dmesg
-Follow the dmesg buffer.
+Follow the dmesg buffer, printing each line once.
     md380-tool dmesgtail
 
 Prints the C5000 baseband registers.
     md380-tool c5000
 Scans for DMR traffic on all color codes.
     md380-tool findcc
-Dumps all the inbound and outbound text messages.
-    md380-tool messages
+Dumps all the inbound and outbound text messages, to the screen or
+to a .json or .csv file with the names of the other parties.
+    md380-tool messages [<messages.json|messages.csv>]
+Run a remote key macro, see md380_macro.py for the commands.
+    md380-tool macro <macro.txt>
 Dumps all the keys.
     md380-tool keys
 
 Dump a screenshot.
-    md380-tool screenshot <filename.bmp>
+    md380-tool screenshot <filename.bmp|filename.png>
+Record the screen at up to <fps> frames per second (default 10), as
+raw RGB24 to stdout or a .rgb file, or as the changed frames to an
+image sequence such as frame%05d.png.
+    md380-tool stream <-|filename.rgb|pattern.png|filename.png> [fps]
+    md380-tool stream - | ffmpeg -f rawvideo -pix_fmt rgb24 -s 160x128 -r 10 -i - screen.mp4
 
 Prints the SPI Flash Type.
     md380-tool spiflashid
@@ -747,6 +1352,13 @@ Dumps memory in hex.
     md380-tool hexdump <0xcafebabe>
 Watches a hex address.
     md380-tool hexwatch <0xcafebabe>
+Print the changes of many memory regions, given as symbol[:size],
+0xaddress[:size] or name=0xaddress[:size].  Symbols are read from the
+files in $MD380_SYMBOLS; set $MD380_WATCH_LOG to log to a file.
+    md380-tool watch <region> [<region> ...]
+Print calls as they are heard, one JSON object per line, with the
+caller looked up in the user database.
+    md380-tool calllog
 Dump one word.
     md380-tool readword <0xcafebabe>
 Dump 1kB from arbitrary address
@@ -756,9 +1368,18 @@ Dump calibration data
 Reboot into the bootloader (erases application, you _must_ reflash firmware afterwards):
     md380-tool reboot_to_bootloader
 
+Keep the radio open and serve other md380-tool calls over a Unix socket
+($MD380_SOCKET, default md380-tool.sock in /tmp).  While it runs,
+md380-tool forwards each operation to it instead of opening USB.
+    md380-tool daemon
+
 Copy File to SPI flash.
     md380-tool spiflashwrite <filename> <address>"
 
+Copy File to SPI flash, erasing and writing only the blocks that changed.
+The optional manifest caches block hashes, so later updates skip the read-back.
+    md380-tool spiflashupdate <filename> <address> [manifest.json]
+
 Copy users.csv to SPI flash:
     wc -c < db/users.csv > data ; cat db/users.csv >> data
     md380-tool spiflashwrite data 0x100000
@@ -769,16 +1390,20 @@ Copy users.csv to SPI flash:
 
 def main():
     try:
-        if len(sys.argv) == 2:
+        if len(sys.argv) >= 3 and sys.argv[1] == 'watch':
+            dfu = init_dfu()
+            watch(dfu, sys.argv[2:])
+
+        elif len(sys.argv) == 2:
             if sys.argv[1] == 'dmesg':
                 dfu = init_dfu()
                 dmesg(dfu)
             elif sys.argv[1] == 'dmesgtail':
                 dfu = init_dfu()
                 dmesgtail(dfu)
-            #             elif sys.argv[1] == 'calllog':
-            #                 dfu=init_dfu();
-            #                 calllog(dfu);
+            elif sys.argv[1] == 'calllog':
+                dfu = init_dfu()
+                calllog(dfu)
             elif sys.argv[1] == 'date':
                 dfu = init_dfu()
                 calldate(dfu)
@@ -819,6 +1444,9 @@ def main():
             elif sys.argv[1] == 'screenshot':
                 dfu = init_dfu()
                 screenshot(dfu)
+            elif sys.argv[1] == 'daemon':
+                import md380_daemon
+                md380_daemon.serve()
             else:
                 usage()
 
@@ -847,8 +1475,19 @@ def main():
                 print("Dumping memory from %s." % sys.argv[2])
                 dfu = init_dfu()
                 hexwatch(dfu, sys.argv[2])
-            elif sys.argv[1] == 'lookup':
+            elif sys.argv[1] == 'find':
+                for user in users.findusers(sys.argv[2]):
+                    print(users.getusername(int(user[0])))
+            elif sys.argv[1] == 'lookup' and sys.argv[2].isdigit():
                 print(users.getusername(int(sys.argv[2])))
+            elif sys.argv[1] == 'lookup' and sys.argv[2] == '-':
+                lookuplines(iter(sys.stdin.readline, ''))
+            elif sys.argv[1] == 'lookup':
+                with open(sys.argv[2]) as f:
+                    lookuplines(f)
+            elif sys.argv[1] == 'userdb':
+                import md380_users
+                md380_users.convert(sys.argv[2], sys.path[0] + '/user.idx')
             elif sys.argv[1] == 'readword':
                 dfu = init_dfu()
                 readword(dfu, sys.argv[2])
@@ -859,6 +1498,16 @@ def main():
             elif sys.argv[1] == 'screenshot':
                 dfu = init_dfu()
                 screenshot(dfu, sys.argv[2])
+            elif sys.argv[1] == 'messages':
+                dfu = init_dfu()
+                exportmessages(dfu, sys.argv[2])
+            elif sys.argv[1] == 'stream':
+                dfu = init_dfu()
+                stream(dfu, sys.argv[2])
+            elif sys.argv[1] == 'macro':
+                import md380_macro
+                dfu = init_dfu()
+                md380_macro.run_file(dfu, sys.argv[2])
             else:
                 usage()
 
@@ -871,10 +1520,34 @@ def main():
                     spiflashwrite(dfu, sys.argv[2], adr)
                 else:
                     print("address too low")
+            elif sys.argv[1] == 'spiflashupdate':
+                adr = int(sys.argv[3], 16)
+                if adr >= int("0x100000", 16):
+                    dfu = init_dfu()
+                    spiflashupdate(dfu, sys.argv[2], adr)
+                else:
+                    print("address too low")
+            elif sys.argv[1] == 'userdb':
+                import md380_users
+                md380_users.convert(sys.argv[2], sys.argv[3])
             elif sys.argv[1] == 'dump':
                 print("Dumping memory from %s." % sys.argv[3])
                 dfu = init_dfu()
                 dump(dfu, sys.argv[2], sys.argv[3])
+            elif sys.argv[1] == 'stream':
+                dfu = init_dfu()
+                stream(dfu, sys.argv[2], float(sys.argv[3]))
+            else:
+                usage()
+
+        elif len(sys.argv) == 5:
+            if sys.argv[1] == 'spiflashupdate':
+                adr = int(sys.argv[3], 16)
+                if adr >= int("0x100000", 16):
+                    dfu = init_dfu()
+                    spiflashupdate(dfu, sys.argv[2], adr, sys.argv[4])
+                else:
+                    print("address too low")
             else:
                 usage()
 
@@ -884,7 +1557,7 @@ def main():
     except RuntimeError as e:
         print(e.args[0])
         exit(1)
-    except usb.core.USBError as ue:
+    except usb_errors() as ue:
         print(ue)
         if ue[0] == 32:
             print('Make sure the device is already flashed with custom firmware and NOT in DFU mode')
@@ -0,0 +1,463 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Indexed binary form of the user database (db/stripped.csv, user.bin).
+#
+# Parsing the whole CSV into a dict costs seconds and hundreds of MB
+# with the worldwide ID list.  The index file is memory-mapped
+# instead, and an ID is found by bisection, touching a few pages.
+#
+# Layout, all little endian:
+#
+#     magic    8 bytes "MD380USR"
+#     version  u32, 2
+#     count    u32, number of users
+#     source   u32 size and 20 byte SHA-1 of the CSV, see fingerprint()
+#     ids      count * u32, sorted
+#     offsets  (count + 1) * u32, into the heap
+#     heap     the rows without their ID, fields separated by NUL
+#
+# Row i is heap[offsets[i]:offsets[i + 1]].  Rows keep the column
+# order of db/stripped.csv, see user_fields in md380_tool.py.  The
+# source fingerprint tells whether the index still matches a CSV;
+# `make flashdb` rewrites user.bin with the same rows, so file times
+# can't tell.
+#
+# Next to it, user.names indexes the rows by callsign and by name,
+# both upper case with single spaces (see normalize()), for exact and
+# prefix searches by bisection:
+#
+#     magic    8 bytes "MD380NAM"
+#     version  u32, 1
+#     count    u32, number of keys
+#     rows     count * u32, row number in the index file
+#     offsets  (count + 1) * u32, into the key heap
+#     heap     the keys, sorted
+#
+# build() makes db/stripped.csv and its index from the downloaded
+# sources in one streaming pass, see db/Makefile.  Each source is
+# transliterated to ASCII, reordered to the stripped.csv columns and
+# sorted by ID in runs of bounded size (spilled to temporary files);
+# the runs of all sources are then merged in ID order, and for IDs in
+# several sources the first source wins.  The merged sources other
+# than custom.csv are kept in a base file, so that editing custom.csv
+# only merges it into the base again.
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import unicodedata
+
+magic = b"MD380USR"
+names_magic = b"MD380NAM"
+version = 2
+names_version = 1
+header = struct.Struct("<8sLL")
+source = struct.Struct("<L20s")
+
+
+def text(data):
+    """Bytes from the file as a native string."""
+    if str is bytes:
+        return data
+    return data.decode('utf-8', 'replace')
+
+
+def read_csv(filename):
+    """Yields (id, row) from a user CSV; the first row of an ID wins,
+    like db/combine.awk.  Accepts user.bin with its length line."""
+    seen = set()
+    with open(filename, 'rb') as f:
+        for line in f:
+            row = line.rstrip(b"\r\n").split(b",")
+            if len(row) < 2:
+                continue  # user.bin starts with its size
+            try:
+                id = int(row[0])
+            except ValueError:
+                continue
+            if id in seen:
+                continue
+            seen.add(id)
+            yield id, row
+
+
+def normalize(key):
+    """Search key of a callsign or name: upper case, single spaces."""
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return b" ".join(key.upper().split())
+
+
+def fingerprint(filename):
+    """The source field of an index of a user CSV: the size and hash
+    of its rows.  Hashing the worldwide list takes a fraction of the
+    time parsing it does.  user.bin's length line is skipped, so it
+    matches the db/stripped.csv it was made from."""
+    size = 0
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        first = f.readline()
+        if b"," in first:
+            f.seek(0)
+        for block in iter(lambda: f.read(1 << 20), b""):
+            size += len(block)
+            digest.update(block)
+    return source.pack(size, digest.digest())
+
+
+def names_filename(filename):
+    return os.path.splitext(filename)[0] + '.names'
+
+
+def replace(tmp, filename):
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)  # rename doesn't replace files on Windows
+    os.rename(tmp, filename)
+
+
+class TableWriter(object):
+    """Writes a header, a u32 array and an offset-indexed heap, from
+    (number, item) pairs added in order.  The arrays and the heap
+    are kept in temporary files until close(), and extra is written
+    between the header and the arrays."""
+
+    def __init__(self, filename, file_magic, file_version, extra=b""):
+        self.filename = filename
+        self.magic = file_magic
+        self.version = file_version
+        self.extra = extra
+        tmpdir = os.path.dirname(os.path.abspath(filename))
+        self.parts = [tempfile.TemporaryFile(dir=tmpdir) for i in range(3)]
+        self.numbers, self.offsets, self.heap = self.parts
+        self.count = 0
+        self.size = 0
+        self.offsets.write(struct.pack("<L", 0))
+
+    def add(self, number, item):
+        self.numbers.write(struct.pack("<L", number))
+        self.heap.write(item)
+        self.size += len(item)
+        self.offsets.write(struct.pack("<L", self.size))
+        self.count += 1
+
+    def close(self):
+        tmp = self.filename + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(header.pack(self.magic, self.version, self.count))
+            f.write(self.extra)
+            for part in self.parts:
+                part.seek(0)
+                shutil.copyfileobj(part, f)
+                part.close()
+        replace(tmp, self.filename)
+
+
+def write_index(users, filename, run_size=100000, csv_filename=None):
+    """Writes (id, row) pairs, in any order, as an index file and its
+    name index.  The first row of an ID wins.  Sorting spills to
+    temporary files, so memory holds about run_size rows.  The index
+    records the fingerprint of csv_filename, read once the pairs are
+    exhausted; without one it matches no CSV."""
+    tmpdir = os.path.dirname(os.path.abspath(filename))
+    index = TableWriter(filename, magic, version, source.pack(0, b""))
+
+    def keys():
+        rows = merge([sorted_runs(users, tmpdir, run_size)])
+        for i, (id, row) in enumerate(rows):
+            index.add(id, b"\0".join(field.strip() for field in row[1:]))
+            for field in row[1:3]:  # callsign and name
+                key = normalize(field)
+                if key:
+                    yield key, [key, b"%d" % i]
+
+    names = TableWriter(names_filename(filename), names_magic, names_version)
+    last = None
+    for key, row in merge([sorted_runs(keys(), tmpdir, run_size, read_keys)],
+                          unique=False):
+        i = row[1]
+        if (key, i) != last:  # a callsign may also be the name
+            last = key, i
+            names.add(int(i), key)
+    if csv_filename is not None:
+        index.extra = fingerprint(csv_filename)
+    index.close()
+    names.close()
+
+
+def convert(csv_filename, filename):
+    write_index(read_csv(csv_filename), filename, csv_filename=csv_filename)
+
+
+class Table(object):
+    """A memory-mapped file written by a TableWriter, with extra_size
+    bytes of extra."""
+
+    def __init__(self, filename, file_magic, file_version, extra_size=0):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        m, v, self.count = header.unpack_from(self.map, 0)
+        if m != file_magic or v != file_version:
+            self.map.close()
+            raise ValueError('%s is not a user index' % filename)
+        self.extra = self.map[header.size:header.size + extra_size]
+        self.numbers = header.size + extra_size
+        self.offsets = self.numbers + 4 * self.count
+        self.heap = self.offsets + 4 * (self.count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def number_at(self, i):
+        return struct.unpack_from("<L", self.map, self.numbers + 4 * i)[0]
+
+    def item_at(self, i):
+        start, end = struct.unpack_from("<LL", self.map, self.offsets + 4 * i)
+        return self.map[self.heap + start:self.heap + end]
+
+    def close(self):
+        self.map.close()
+
+
+class IndexedUsers(Table):
+    """A memory-mapped index file, with its name index if present."""
+
+    def __init__(self, filename):
+        Table.__init__(self, filename, magic, version, source.size)
+        self.filename = filename
+        self.names = None
+
+    def id_at(self, i):
+        return self.number_at(i)
+
+    def row_at(self, i):
+        fields = self.item_at(i).split(b"\0")
+        return ["%d" % self.id_at(i)] + [text(field) for field in fields]
+
+    def search(self, key, prefix=True):
+        """Yields the rows whose callsign or name is key, or starts
+        with it, in key order."""
+        if self.names is None:
+            self.names = Table(names_filename(self.filename), names_magic,
+                               names_version)
+        names = self.names
+        key = normalize(key)
+        lo, hi = 0, names.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if names.item_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        seen = set()
+        for i in range(lo, names.count):
+            found = names.item_at(i)
+            if not (found.startswith(key) if prefix else found == key):
+                break
+            row = names.number_at(i)
+            if row not in seen:
+                seen.add(row)
+                yield self.row_at(row)
+
+    def find(self, id):
+        """Returns the position of id, or None."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.id_at(mid) < id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.id_at(lo) == id:
+            return lo
+        return None
+
+    def get(self, id):
+        """Returns the row of an ID, or None."""
+        i = self.find(id)
+        if i is None:
+            return None
+        return self.row_at(i)
+
+
+# Letters that don't decompose into an ASCII letter and an accent.
+translit = {
+    ord(u'\u00c6'): u'AE', ord(u'\u00e6'): u'ae',  # Ææ
+    ord(u'\u00d0'): u'D', ord(u'\u00f0'): u'd',  # Ðð
+    ord(u'\u00d8'): u'O', ord(u'\u00f8'): u'o',  # Øø
+    ord(u'\u00de'): u'TH', ord(u'\u00fe'): u'th',  # Þþ
+    ord(u'\u00df'): u'ss',  # ß
+    ord(u'\u0110'): u'D', ord(u'\u0111'): u'd',  # Đđ
+    ord(u'\u0141'): u'L', ord(u'\u0142'): u'l',  # Łł
+    ord(u'\u0152'): u'OE', ord(u'\u0153'): u'oe',  # Œœ
+}
+
+
+def transliterate(data):
+    """ASCII form of UTF-8 bytes, like iconv -c -t ascii//TRANSLIT:
+    accents are dropped, other characters left out."""
+    text = data.decode('utf-8', 'ignore').translate(translit)
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore')
+
+
+def read_source(filename, nick=False):
+    """Yields (id, row) of a source CSV in the order of stripped.csv,
+    transliterated and trimmed.  Sources have the columns id, callsign,
+    name, nickname, city, state, country; with nick set they have no
+    nickname, like the DMR-MARC list (db/insert_nick.awk before)."""
+    with open(filename, 'rb') as f:
+        for line in f:
+            row = transliterate(line.rstrip(b"\r\n")).split(b",")
+            if nick:
+                row = row[:3] + [b""] + row[3:6]
+            row = [field.strip(b" \t") for field in row[:7]]
+            row += [b""] * (7 - len(row))
+            try:
+                id = int(row[0])
+            except ValueError:
+                continue  # headers and blank lines
+            yield id, [row[0], row[1], row[2], row[4], row[5], row[3], row[6]]
+
+
+def read_stripped(f):
+    """Yields (id, row) of a stripped.csv file object."""
+    for line in f:
+        row = line.rstrip(b"\n").split(b",")
+        yield int(row[0]), row
+
+
+def read_keys(f):
+    """Yields (key, [key, row number]) of a name key run."""
+    for line in f:
+        row = line.rstrip(b"\n").split(b",")
+        yield row[0], row
+
+
+def sorted_runs(rows, tmpdir, run_size, read=read_stripped):
+    """Sorts (id, row) pairs by ID in runs of at most run_size rows.
+    Returns a list of iterables; all but a last short run are written
+    to temporary files as CSV and read back with read.  Sorting is
+    stable, so the first row of an ID stays first."""
+    runs = []
+    while True:
+        run = []
+        for pair in rows:
+            run.append(pair)
+            if len(run) == run_size:
+                break
+        run.sort(key=lambda pair: pair[0])
+        if len(run) < run_size:
+            runs.append(run)
+            return runs
+        f = tempfile.TemporaryFile(dir=tmpdir)
+        f.writelines(b",".join(row) + b"\n" for id, row in run)
+        f.seek(0)
+        runs.append(read(f))
+
+
+def ranked(rank, run):
+    for n, (id, row) in enumerate(run):
+        yield id, rank, n, row
+
+
+def merge(sources, unique=True):
+    """Merges sorted runs, given as a list of lists of runs in order of
+    precedence, yielding (id, row) in ID order, once per ID if unique
+    is set."""
+    last = None
+    keyed = [ranked((rank, i), run)
+             for rank, runs in enumerate(sources)
+             for i, run in enumerate(runs)]
+    for id, rank, n, row in heapq.merge(*keyed):
+        if id != last or not unique:
+            last = id
+            yield id, row
+
+
+def newer(target, sources):
+    if not os.path.exists(target):
+        return False
+    mtime = os.path.getmtime(target)
+    return all(os.path.getmtime(source) <= mtime for source in sources)
+
+
+def write_rows(rows, filename):
+    """Writes (id, row) as CSV, passing them on."""
+    tmp = filename + ".tmp"
+    with open(tmp, 'wb') as f:
+        for id, row in rows:
+            f.write(b",".join(row) + b"\n")
+            yield id, row
+    replace(tmp, filename)
+
+
+def build(custom, sources, output, index=None, base=None, privacy=False,
+          run_size=100000):
+    """Builds stripped.csv, and an index file if given, from custom.csv
+    and the other sources, a list of (filename, nick) in order of
+    precedence (see read_source).  With privacy set the names are left
+    out, for countries where the list may not carry them.
+
+    The merged other sources are kept in base, if given, and reused
+    while it is newer than all of them.  Memory holds run_size rows per
+    source and for the index."""
+    tmpdir = os.path.dirname(os.path.abspath(output))
+
+    def others():
+        return merge([sorted_runs(read_source(filename, nick), tmpdir, run_size)
+                      for filename, nick in sources])
+
+    def finish(others):
+        rows = merge([sorted_runs(read_source(custom), tmpdir, run_size), [others]])
+        if privacy:
+            rows = ((id, row[:2] + [b""] + row[3:]) for id, row in rows)
+        rows = write_rows(rows, output)
+        if index is not None:
+            write_index(rows, index, run_size, csv_filename=output)
+        else:
+            for pair in rows:
+                pass
+
+    if base is None:
+        finish(others())
+        return
+    if not newer(base, [filename for filename, nick in sources]):
+        for pair in write_rows(others(), base):
+            pass
+    with open(base, 'rb') as f:
+        finish(read_stripped(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the user database, db/stripped.csv, and its index')
+    parser.add_argument('--custom', default='custom.csv',
+                        help='entries that override all sources (default custom.csv)')
+    parser.add_argument('--source', '-s', dest='sources', action='append', default=[],
+                        type=lambda filename: (filename, False),
+                        help='source CSV, in order of precedence, may be repeated')
+    parser.add_argument('--nick-source', '-n', dest='sources', action='append',
+                        type=lambda filename: (filename, True),
+                        help='source CSV without a nickname column, like -s')
+    parser.add_argument('--out', '-o', default='stripped.csv',
+                        help='CSV to write (default stripped.csv)')
+    parser.add_argument('--index', '-i', default=None,
+                        help='index file to write as well')
+    parser.add_argument('--base', '-b', default=None,
+                        help='file to keep the merged sources in, for rebuilding '
+                             'quickly when only the custom entries change')
+    parser.add_argument('--privacy', action='store_true',
+                        help='leave out the names')
+    args = parser.parse_args()
+    build(args.custom, args.sources, args.out, args.index, args.base, args.privacy)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Memory watch engine behind md380-tool watch and hexwatch.
+#
+# A region is a name, an address and a size, given as
+#
+#     md380_radio_config         a symbol, 4 bytes
+#     md380_radio_config:16      a symbol and a size
+#     0x2001d098:8               a raw address
+#     state=0x2001d098:4         a raw address with a name
+#
+# Symbols come from the applet's symbol files (name = 0x... ;).  The
+# regions are sorted and coalesced, so regions close to each other
+# cost one peek between them, and each sweep reads every region once.
+# Only changes are reported, stamped with the time of the sweep.
+
+from __future__ import print_function
+
+import re
+import sys
+import time
+
+symbol_line = re.compile(r'^\s*(\w+)\s*=\s*(0x[0-9a-fA-F]+)\s*;')
+
+
+def load_symbols(filename, symbols=None):
+    """Reads `name = 0x... ;` lines into a {name: address} dict."""
+    if symbols is None:
+        symbols = {}
+    with open(filename) as f:
+        for line in f:
+            m = symbol_line.match(line)
+            if m:
+                symbols[m.group(1)] = int(m.group(2), 16)
+    return symbols
+
+
+class Region(object):
+    def __init__(self, name, address, size=4):
+        self.name = name
+        self.address = address
+        self.size = size
+        self.value = None
+
+    def __repr__(self):
+        return "%s@0x%08x:%d" % (self.name, self.address, self.size)
+
+
+def parse_region(spec, symbols={}):
+    """Makes a Region of one of the forms in the header comment."""
+    name, _, rest = spec.rpartition('=')
+    where, _, size = rest.partition(':')
+    size = int(size, 0) if size else 4
+    if where in symbols:
+        address = symbols[where]
+    else:
+        try:
+            address = int(where, 0)
+        except ValueError:
+            raise RuntimeError('Unknown symbol %s' % where)
+    return Region(name or where, address, size)
+
+
+def coalesce(regions, max_read=1024, gap=32):
+    """Groups regions into as few reads as possible.
+
+    Regions are merged into one read when the bytes between them are
+    no more than gap and the read stays within max_read bytes.
+    Returns a list of (address, size, [regions])."""
+    reads = []
+    for r in sorted(regions, key=lambda r: r.address):
+        if reads:
+            adr, size, members = reads[-1]
+            end = max(adr + size, r.address + r.size)
+            if r.address <= adr + size + gap and end - adr <= max_read:
+                reads[-1] = (adr, end - adr, members + [r])
+                continue
+        reads.append((r.address, r.size, [r]))
+    return reads
+
+
+class Watch(object):
+    """Polls a set of regions, reporting their changes."""
+
+    def __init__(self, dfu, regions, max_read=1024, gap=32):
+        self.dfu = dfu
+        self.regions = regions
+        self.reads = coalesce(regions, max_read, gap)
+
+    def sweep(self):
+        """Reads every region once and returns the time and a list of
+        (region, old, new) for those that changed.  Regions are new
+        on the first sweep, with old None."""
+        t = time.time()
+        changes = []
+        for adr, size, members in self.reads:
+            data = bytearray(self.dfu.peek(adr, size))
+            for r in members:
+                value = data[r.address - adr:r.address - adr + r.size]
+                if value != r.value:
+                    changes.append((r, r.value, value))
+                    r.value = value
+        return t, changes
+
+    def run(self, out=sys.stdout, interval=0.05, count=None):
+        """Sweeps every interval seconds, writing one line per change."""
+        n = 0
+        while count is None or n < count:
+            started = time.time()
+            t, changes = self.sweep()
+            for r, old, new in changes:
+                out.write("%s.%03d %s\n" % (time.strftime("%H:%M:%S", time.localtime(t)),
+                                            int(t * 1000) % 1000,
+                                            format_change(r, old, new)))
+            if changes:
+                out.flush()
+            n += 1
+            time.sleep(max(0, interval - (time.time() - started)))
+
+
+def format_change(region, old, new):
+    """name@address: old -> new, as a little endian word if the region
+    is one, else as hex bytes."""
+    if region.size == 4:
+        fmt = lambda v: "0x%08x" % (v[0] | v[1] << 8 | v[2] << 16 | v[3] << 24)
+    else:
+        fmt = lambda v: " ".join("%02x" % b for b in v)
+    text = "%s@%08x: " % (region.name, region.address)
+    if old is None:
+        return text + fmt(new)
+    return text + "%s -> %s" % (fmt(old), fmt(new))
@@ -11,13 +11,93 @@
 #          installing wxPython V4.0.0a ("Phoenix") on a certain
 #          Linux distro was a painful experience .
 #      So stick to wxPython V3 until the Phoenix bird can fly.
+# 2026-10: USB traffic moved to a worker thread (RemoteWorker), so the
+#          GUI no longer freezes while a frame is read. Key events go
+#          through a priority queue ahead of the screen reads.
 #
 import wx
 import array
+import threading
+import Queue
 from md380_tool import *
 
 dfu = None
 online = 0
+worker = None
+
+
+# ----------------------------------------------------------------------
+class RemoteWorker(threading.Thread):
+    # The only thread that talks to the radio. Key events are queued
+    # with a higher priority than screen reads, and taken off the queue
+    # between the tiles of a frame, so a key press waits at most for
+    # the tile being read when it arrives. Each frame is
+    # read into the back buffer (ScreenStream.frame); a copy goes to
+    # the GUI thread, which builds the bitmap it paints from (the front
+    # buffer). The pause between frames follows the measured read time,
+    # and the next frame is scheduled with wx.CallLater on the GUI's
+    # event loop.
+    KEY_EVENT = 0
+    GRAB_FRAME = 1
+
+    def __init__(self, dfu, on_frame, min_pause=0.02, max_pause=0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dfu = dfu
+        self.on_frame = on_frame   # called (via wx.CallAfter) with RGB bytes
+        self.min_pause = min_pause
+        self.max_pause = max_pause
+        self.queue = Queue.PriorityQueue()
+        self.seq = 0               # keeps key presses and releases in order
+        self.lock = threading.Lock()
+        self.stream = ScreenStream(dfu, between=self.send_keys)
+        self.frame_time = 0.0      # seconds needed for the last frame
+        self.n_errors = 0
+
+    def put(self, priority, item):
+        with self.lock:
+            self.seq += 1
+            self.queue.put((priority, self.seq, item))
+
+    def send_key(self, key, pressed):
+        self.put(self.KEY_EVENT, (key, pressed))
+
+    def send_key_event(self, item):
+        try:
+            self.dfu.send_keyboard_event(item[0], item[1])
+        except Exception:
+            self.n_errors += 1
+
+    def send_keys(self):
+        # Sends the key events that arrived while a frame is being read.
+        while True:
+            try:
+                entry = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            if entry[0] != self.KEY_EVENT:
+                self.queue.put(entry)
+                return
+            self.send_key_event(entry[2])
+
+    def run(self):
+        self.put(self.GRAB_FRAME, None)
+        while True:
+            priority, seq, item = self.queue.get()
+            if priority == self.KEY_EVENT:
+                self.send_key_event(item)
+                continue
+            t = time.time()
+            try:
+                if self.stream.next() or self.stream.count == 1:
+                    wx.CallAfter(self.on_frame, bytes(bgr_to_rgb(self.stream.frame)))
+            except Exception:
+                self.n_errors += 1  # don't worry, the next frame will fix it
+            self.frame_time = time.time() - t
+            # Leave the link idle about as long as a frame took, so
+            # key events and other USB traffic get their share.
+            pause = min(self.max_pause, max(self.min_pause, self.frame_time))
+            wx.CallAfter(wx.CallLater, int(pause * 1000), self.put, self.GRAB_FRAME, None)
 
 
 # ----------------------------------------------------------------------
@@ -27,12 +107,6 @@ class RemoteScreenPanel(wx.Panel):
         self.Bind(wx.EVT_PAINT, self.OnPaint)
 
         self.make_offline_bitmap(self.Size.width, self.Size.height)
-        self.timer = wx.Timer(self)
-        self.Bind(wx.EVT_TIMER, self.OnTimer, self.timer )
-        # ex: self.timer.StartOnce(500)  # interval in milliseconds, fire ONCE !
-        # -> "AttributeError: 'Timer' object has no attribute 'StartOnce'" . Sigh,,
-        self.timer.Start(500, wx.TIMER_ONE_SHOT)  # interval in milliseconds, fire ONCE !
-        self.n_errors = 0
 
     def make_offline_bitmap(self, width, height):
         # Make a bitmap using an array of RGB bytes, similar as lcd_driver.c : LCD_ColorGradientTest()
@@ -64,39 +138,12 @@ class RemoteScreenPanel(wx.Panel):
         dc = wx.PaintDC(self)
         self.DrawRemoteScreen(dc, self.rgbBmp)
 
-    def GrabRemoteScreen(self):
-        # Grab the LCD framebuffer via USB and convert to a (wx-) bitmap
-        # Read image data with 160 pixels per line, 3 bytes per pixel.
-        width = 160 # width of the MD380 LCD in pixels
-        height= 128 # height of the MD380 LCD in pixels
-        bpp = 3  # bytes per pixel
-        bytes = array.array('B', [0] * width*height*bpp)
-        h = self.Size.height
-        w = self.Size.width
-        for y in xrange(height):
-            buf = dfu.read_framebuf_line(y)
-            if len(buf) == bpp*width: # successfully read from framebuffer
-               for x in xrange(width):
-                   offset = y*width*bpp + x*bpp
-                   bytes[offset + 0] = buf[3*x+2] # red
-                   bytes[offset + 1] = buf[3*x+1] # green
-                   bytes[offset + 2] = buf[3*x+0] # blue
-            else: # framebuffer access failed (e.g. LCD driver or controller was busy)
-                self.n_errors +=1  # don't worry, the next periodic update will fix it
-
-        self.rgbBmp = wx.BitmapFromBuffer(width, height, bytes) # "deprecated" in wxPython V4
+    def OnFrame(self, rgb_bytes):
+        # Called on the GUI thread with a complete frame from RemoteWorker,
+        # 160 pixels per line, 3 bytes per pixel (red, green, blue).
+        self.rgbBmp = wx.BitmapFromBuffer(160, 128, rgb_bytes) # "deprecated" in wxPython V4
         # ex: self.rgbBmp = wx.Bitmap.FromBuffer(width, height, bytes) # incompatible with wxPython V3
-
-
-    def OnTimer(self,event):
-        if online:
-           self.GrabRemoteScreen()
-           self.Refresh() # let wxPython call OnPaint() when it's time to..
-           # Allow some time to pass BETWEEN two timer-calls,
-           # regardless of how long the above operations have taken.
-           # Firing the timer event every 200 ms may be asking too much.
-           # ex: self.timer.StartOnce(200) # ok for wxPython V4, incompatible with V3
-           self.timer.Start(200, wx.TIMER_ONE_SHOT) # interval in milliseconds, fire ONCE !
+        self.Refresh() # let wxPython call OnPaint() when it's time to..
 
 #----------------------------------------------------------------------
 class RemoteKeyboardPanel(wx.Panel):
@@ -136,7 +183,7 @@ class RemoteKeyboardPanel(wx.Panel):
         # Get the clicked button's label, and convert to single-char 'key'
         key = self.label_to_key( evt.GetEventObject().GetLabel() )
         if online: # send the key as 'remote control' key ?
-           dfu.send_keyboard_event( key.encode('ascii','ignore'), 1)
+           worker.send_key( key.encode('ascii','ignore'), 1)
         # from Robin Dunn:
         # > It may depend on the platform, but I've seen cases where
         # > if the LEFT_DOWN handler eats the event then the system
@@ -148,7 +195,7 @@ class RemoteKeyboardPanel(wx.Panel):
     def OnLeftBtnUpForRemote(self, evt):
         key = self.label_to_key(evt.GetEventObject().GetLabel())
         if online:  # signal 'key RELEASED' to the remotely controlled rig:
-            dfu.send_keyboard_event( key.encode('ascii', 'ignore'), 0)
+            worker.send_key( key.encode('ascii', 'ignore'), 0)
         evt.Skip() # let others (the "system"?) process this event, too
 
 
@@ -218,5 +265,8 @@ if __name__ == '__main__':
         online = False
     app = wx.App()
     frame = MainFrame()
+    if online:
+        worker = RemoteWorker(dfu, frame.imgPanel.OnFrame)
+        worker.start()
     frame.Show()
     app.MainLoop()
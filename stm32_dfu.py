@@ -406,8 +406,9 @@ def detach(dfu):
         print('In unexpected state: %s' % dfu.get_state())
 
 
-def init_dfu(idVendor=stm32_vendor, idProduct=stm32_product):
-    dev = usb.core.find(idVendor=idVendor, idProduct=idProduct)
+def init_dfu(idVendor=stm32_vendor, idProduct=stm32_product, dev=None):
+    if dev is None:
+        dev = usb.core.find(idVendor=idVendor, idProduct=idProduct)
     if dev is None:
         raise RuntimeError('Device not found')
 